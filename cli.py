@@ -0,0 +1,201 @@
+"""
+命令行入口
+Gemini SDK 和生成流程只在子命令需要时才导入和构建，不调用 API 的子命令启动很快：
+
+    python cli.py generate --count 3     # 依次生成 3 本小说
+    python cli.py reprocess              # 重新解析、验证并保存 output/errors 中的失败响应，不重新生成
+    python cli.py validate FILE          # 验证单个文件（AI 原始响应、小说 JSON 或正文）
+    python cli.py prompt --dry-run       # 构建提示词并给出生成计划，token 数离线估算
+    python cli.py bench                  # 测量各子命令的启动耗时
+
+加 --profile（如 python cli.py --profile generate）为每个任务写入性能报告，等同于 NOVEL_PROFILE=1
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+PROJECT_DIR = Path(__file__).resolve().parent
+
+
+def cmd_generate(args):
+    from main import main as generate
+
+    generate(count=args.count)
+    return 0
+
+
+def cmd_reprocess(args):
+    from main import load_config, create_services, create_shared
+    from nodes import ParseNovelNode, ValidateNovelNode, SaveNovelNode
+    from utils.profiling import profile_job
+
+    error_dir = Path(args.dir)
+    files = sorted(error_dir.glob("*.txt"))
+    if not files:
+        print(f"{error_dir} 中没有失败响应")
+        return 0
+
+    config = load_config()
+    services = create_services()
+    recovered_dir = error_dir / "recovered"
+    recovered = 0
+    for error_file in files:
+        print(f"\n== {error_file.name}")
+        shared = create_shared(config, services)
+        shared["raw_response"] = error_file.read_text(encoding="utf-8")
+
+        # 依次运行解析、验证和保存节点，失败时不重新生成
+        with profile_job(shared, name=f"reprocess-{error_file.stem}"):
+            saved = (ParseNovelNode().run(shared) != "retry"
+                     and ValidateNovelNode().run(shared) == "pass"
+                     and SaveNovelNode().run(shared) == "default")
+        if not saved:
+            continue
+
+        recovered_dir.mkdir(exist_ok=True)
+        shutil.move(str(error_file), recovered_dir / error_file.name)
+        recovered += 1
+
+    print(f"\n已恢复 {recovered}/{len(files)} 个失败响应（原文件移至 {recovered_dir}）")
+    return 0
+
+
+def cmd_validate(args):
+    from utils.novel_parser import parse_novel
+    from utils.validator import validate_content
+
+    path = Path(args.file)
+    text = path.read_text(encoding="utf-8")
+    if path.suffix == ".json":
+        content = json.loads(text)["content"]
+    elif "CONTENT{" in text:
+        # AI 原始响应：先解析
+        try:
+            content = parse_novel(text)["content"]
+        except ValueError as e:
+            print(f"✗ 解析失败: {e}")
+            return 1
+    else:
+        content = text
+
+    passed, errors = validate_content(content)
+    if passed:
+        print(f"✓ {path} 验证通过")
+        return 0
+    print(f"✗ {path} 验证失败:")
+    for error in errors:
+        print(f"  - {error}")
+    return 1
+
+
+def cmd_prompt(args):
+    from main import load_config
+    from nodes import BuildPromptNode
+    from utils.token_budget import TokenBudget, estimate_tokens
+
+    # dry-run 时离线估算 token 数，不导入 SDK、不调用 API
+    count_fn = (lambda text, _model: estimate_tokens(text)) if args.dry_run else None
+    shared = {
+        "config": load_config(),
+        "token_budget": TokenBudget(model=args.model, count_fn=count_fn),
+        "job_spec": {"template": args.template, "event": args.event},
+    }
+    BuildPromptNode().run(shared)
+
+    if args.output:
+        Path(args.output).write_text(shared["prompt"], encoding="utf-8")
+        print(f"提示词已写入: {args.output}")
+    else:
+        print(shared["prompt"])
+    return 0
+
+
+def _time_command(argv, runs):
+    """在子进程中运行命令 runs 次，返回耗时中位数（毫秒），命令异常退出时返回 None"""
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, *argv], cwd=PROJECT_DIR, capture_output=True)
+        seconds.append(time.perf_counter() - start)
+        # validate 验证失败时退出码为 1，不视为异常
+        if result.returncode not in (0, 1):
+            return None
+    return statistics.median(seconds) * 1000
+
+
+def cmd_bench(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sample_file = Path(tmp_dir) / "sample.txt"
+        sample_file.write_text("这是一段用于测量启动耗时的正文。\n" * 50, encoding="utf-8")
+        empty_dir = Path(tmp_dir) / "errors"
+        empty_dir.mkdir()
+
+        commands = [
+            ("python 解释器", ["-c", "pass"]),
+            # 相当于改为延迟导入之前 python main.py 开始生成前的导入耗时
+            ("基准: import main + google.genai", ["-c", "import main, google.genai"]),
+            ("cli.py --help", ["cli.py", "--help"]),
+            ("validate FILE", ["cli.py", "validate", str(sample_file)]),
+            ("prompt --dry-run", ["cli.py", "prompt", "--dry-run", "--output", os.devnull]),
+            ("reprocess（空目录）", ["cli.py", "reprocess", "--dir", str(empty_dir)]),
+        ]
+
+        print(f"启动耗时（{args.runs} 次运行的中位数）:")
+        baseline = None
+        for name, argv in commands:
+            ms = _time_command(argv, args.runs)
+            if ms is None:
+                print(f"  {name:<36} 运行失败")
+                continue
+            if name.startswith("基准"):
+                baseline = ms
+            ratio = f"  {ms / baseline:.0%}" if baseline else ""
+            print(f"  {name:<36} {ms:8.1f} ms{ratio}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AI 小说自动生成系统")
+    parser.add_argument("--profile", action="store_true", help="为每个任务写入性能报告（output/profiles/）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="生成小说")
+    generate_parser.add_argument("--count", type=int, default=1, help="依次生成的小说数")
+    generate_parser.set_defaults(handler=cmd_generate)
+
+    reprocess_parser = subparsers.add_parser("reprocess", help="重新解析、验证并保存失败响应，不重新生成")
+    reprocess_parser.add_argument("--dir", default="output/errors", help="失败响应目录")
+    reprocess_parser.set_defaults(handler=cmd_reprocess)
+
+    validate_parser = subparsers.add_parser("validate", help="验证单个文件")
+    validate_parser.add_argument("file", help="AI 原始响应、小说 JSON 或正文文件")
+    validate_parser.set_defaults(handler=cmd_validate)
+
+    prompt_parser = subparsers.add_parser("prompt", help="构建提示词并给出生成计划")
+    prompt_parser.add_argument("--dry-run", action="store_true", help="离线估算 token 数，不调用 API")
+    prompt_parser.add_argument("--template", help="命令模板文件名（默认随机）")
+    prompt_parser.add_argument("--event", help="事件（默认随机）")
+    prompt_parser.add_argument("--model", default="gemini-2.5-pro", help="按该模型的上限规划")
+    prompt_parser.add_argument("--output", help="提示词写入文件（默认打印）")
+    prompt_parser.set_defaults(handler=cmd_prompt)
+
+    bench_parser = subparsers.add_parser("bench", help="测量各子命令的启动耗时")
+    bench_parser.add_argument("--runs", type=int, default=5, help="每个命令运行的次数")
+    bench_parser.set_defaults(handler=cmd_bench)
+
+    args = parser.parse_args(argv)
+    if args.profile:
+        os.environ["NOVEL_PROFILE"] = "1"
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
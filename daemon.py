@@ -0,0 +1,316 @@
+"""
+小说生成守护进程
+常驻进程保持配置、Gemini 客户端、流程和统计对象常驻内存，通过本地 HTTP 接口接收任务：
+
+    POST /jobs     提交任务，请求体为 JSONL，每行一个任务描述：
+                   {"job_id": "可选", "count": 1, "template": "可选模板文件名", "event": "可选事件"}
+                   任何一行不合法时返回 400，整个请求的任务都不提交
+    GET  /jobs/ID  查询任务状态（只保留最近结束的 --max-finished-jobs 个任务）
+    GET  /stats    队列深度、执行中任务数和最近任务耗时
+    POST /drain    停止接收新任务，执行中的任务完成后退出
+
+收到 SIGTERM / SIGINT 时同样进入排空流程，尚未开始的任务写入 output/daemon/pending.jsonl，
+可在重启后重新提交；排空期间再次收到信号不会中断执行中的任务
+"""
+import argparse
+import json
+import queue
+import signal
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from flow import create_novel_flow
+from main import load_config, create_services, create_shared
+from utils.profiling import profile_job
+
+
+PENDING_FILE = Path("output/daemon/pending.jsonl")
+
+
+class NovelDaemon:
+    """任务队列和工作线程"""
+
+    def __init__(self, workers: int = 2, latency_window: int = 50, max_finished_jobs: int = 1000):
+        """
+        Args:
+            workers: 并发执行任务的工作线程数
+            latency_window: 统计最近任务耗时的窗口大小
+            max_finished_jobs: 最多保留的已结束任务数，超出后最早结束的任务不再可查询
+        """
+        # 常驻状态：配置、统计和预算对象在所有任务间共享
+        self.config = load_config()
+        self.config["echo_stream"] = False  # 多个任务并发时不打印流式输出
+        self.services = create_services()
+
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.max_finished_jobs = max_finished_jobs
+        self.finished = deque()  # 已结束任务的 ID，按结束顺序
+        self.draining = threading.Event()
+        self.drained = threading.Event()
+        self.started_at = time.time()
+
+        self.workers = [
+            threading.Thread(target=self._worker, name=f"novel-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, spec: dict) -> list[str]:
+        """提交一个任务描述，count > 1 时展开为多个任务，返回任务 ID 列表"""
+        return self.submit_many([spec])
+
+    def submit_many(self, specs: list) -> list[str]:
+        """
+        批量提交任务描述：全部校验通过后才加入队列，任何一个不合法时一个也不提交
+
+        Returns:
+            任务 ID 列表
+
+        Raises:
+            ValueError: 任务描述不是对象、count 不合法或任务 ID 重复
+            RuntimeError: 守护进程正在排空
+        """
+        jobs = []
+        for spec in specs:
+            if not isinstance(spec, dict):
+                raise ValueError(f"任务描述必须是 JSON 对象: {spec!r}")
+            try:
+                count = int(spec.get("count", 1))
+            except (TypeError, ValueError):
+                raise ValueError(f"count 必须是整数: {spec.get('count')!r}")
+            if count < 1:
+                raise ValueError(f"count 必须大于 0: {count}")
+            base_id = spec.get("job_id") or uuid.uuid4().hex[:12]
+            for i in range(count):
+                jobs.append({
+                    "job_id": base_id if count == 1 else f"{base_id}-{i + 1}",
+                    "spec": {k: spec[k] for k in ("template", "event") if spec.get(k)},
+                    "status": "queued",
+                })
+
+        # 排空检查、ID 查重和入队在同一把锁内完成，与 drain 互斥
+        with self.lock:
+            if self.draining.is_set():
+                raise RuntimeError("守护进程正在排空，不再接收新任务")
+            job_ids = [job["job_id"] for job in jobs]
+            for job_id in job_ids:
+                if job_id in self.jobs:
+                    raise ValueError(f"任务 ID 已存在: {job_id}")
+                if job_ids.count(job_id) > 1:
+                    raise ValueError(f"任务 ID 重复: {job_id}")
+            now = time.time()
+            for job in jobs:
+                job["submitted_at"] = now
+                self.jobs[job["job_id"]] = job
+                self.queue.put(job["job_id"])
+        return job_ids
+
+    def _worker(self):
+        # 每个工作线程持有自己的流程实例
+        flow = create_novel_flow()
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                return
+
+            # 状态检查和标记为 running 在同一把锁内完成：drain 已取消的任务不再执行
+            with self.lock:
+                job = self.jobs[job_id]
+                if self.draining.is_set() or job["status"] != "queued":
+                    self.queue.task_done()
+                    continue
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                self.in_flight += 1
+
+            try:
+                shared = create_shared(self.config, self.services, job["spec"])
+                # 多个工作线程并发执行任务时 tracemalloc 无法区分任务，只采集耗时和调用栈
+                with profile_job(shared, name=job_id, concurrent=len(self.workers) > 1):
+                    flow.run(shared)
+                if not shared.get("output_files"):
+                    raise RuntimeError("流程结束但没有保存小说")
+                result = {
+                    "status": "done",
+                    "title": shared["novel"]["title"],
+                    "output_files": shared["output_files"],
+                }
+            except Exception as e:
+                traceback.print_exc()
+                result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+
+            with self.lock:
+                job.update(result)
+                job["finished_at"] = time.time()
+                self.in_flight -= 1
+                if result["status"] == "done":
+                    self.completed += 1
+                    self.latencies.append(job["finished_at"] - job["started_at"])
+                else:
+                    self.failed += 1
+                # 只保留最近结束的任务，常驻进程的内存不随任务总数增长
+                self.finished.append(job_id)
+                while len(self.finished) > self.max_finished_jobs:
+                    del self.jobs[self.finished.popleft()]
+            print(f"任务 {job_id}: {result['status']}")
+            self.queue.task_done()
+
+    def get_job(self, job_id: str) -> dict | None:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self) -> dict:
+        """队列深度、执行中任务数和最近任务耗时"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            queued = sum(1 for job in self.jobs.values() if job["status"] == "queued")
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+            return {
+                "uptime_seconds": time.time() - self.started_at,
+                "draining": self.draining.is_set(),
+                "queue_depth": queued,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "recent_latencies": list(self.latencies),
+                "latency_p50": percentile(0.5),
+                "latency_p95": percentile(0.95),
+            }
+
+    def drain(self):
+        """
+        停止接收新任务，未开始的任务写入 pending 文件，等待执行中的任务完成
+
+        排空已经开始时（如再次收到信号）等待它完成后再返回，调用方随后关闭服务不会中断执行中的任务
+        """
+        with self.lock:
+            already_draining = self.draining.is_set()
+            if not already_draining:
+                self.draining.set()
+                pending = [job for job in self.jobs.values() if job["status"] == "queued"]
+                for job in pending:
+                    job["status"] = "cancelled"
+        if already_draining:
+            print("正在排空，等待执行中的任务完成...")
+            self.drained.wait()
+            return
+
+        print("开始排空：不再接收新任务，等待执行中的任务完成...")
+        if pending:
+            PENDING_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with open(PENDING_FILE, "a", encoding="utf-8") as f:
+                for job in pending:
+                    f.write(json.dumps({"job_id": job["job_id"], **job["spec"]}, ensure_ascii=False) + "\n")
+            print(f"  {len(pending)} 个未开始的任务已写入: {PENDING_FILE}")
+
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.drained.set()
+        print("排空完成")
+
+
+def make_handler(daemon: NovelDaemon):
+    """创建绑定到守护进程实例的请求处理器"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, data):
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, daemon.stats())
+            elif self.path.startswith("/jobs/"):
+                job = daemon.get_job(self.path[len("/jobs/"):])
+                if job is None:
+                    self._send_json(404, {"error": "任务不存在"})
+                else:
+                    self._send_json(200, job)
+            else:
+                self._send_json(404, {"error": "未知路径"})
+
+        def do_POST(self):
+            if self.path == "/drain":
+                threading.Thread(target=lambda: (daemon.drain(), self.server.shutdown()), daemon=True).start()
+                self._send_json(202, {"draining": True})
+                return
+            if self.path != "/jobs":
+                self._send_json(404, {"error": "未知路径"})
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length)
+            try:
+                # 整个请求体校验通过后才提交，出错时不会留下部分已提交的任务
+                lines = body.decode("utf-8").splitlines()
+                specs = [json.loads(line) for line in lines if line.strip()]
+                job_ids = daemon.submit_many(specs)
+            except RuntimeError as e:
+                self._send_json(503, {"error": str(e)})
+                return
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._send_json(202, {"job_ids": job_ids})
+
+        def log_message(self, format, *args):
+            # 只打印提交任务的请求，避免轮询 /stats 刷屏
+            if self.command == "POST":
+                super().log_message(format, *args)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="小说生成守护进程")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址（默认只监听本机）")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口")
+    parser.add_argument("--workers", type=int, default=2, help="并发生成的任务数")
+    parser.add_argument("--max-finished-jobs", type=int, default=1000, help="保留可查询的已结束任务数")
+    args = parser.parse_args()
+
+    daemon = NovelDaemon(workers=args.workers, max_finished_jobs=args.max_finished_jobs)
+    daemon.start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(daemon))
+
+    def shutdown(signum, frame):
+        print(f"\n收到信号 {signum}")
+        # 在独立线程中排空，完成后关闭 HTTP 服务
+        threading.Thread(target=lambda: (daemon.drain(), server.shutdown()), daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print(f"守护进程已启动: http://{args.host}:{args.port} (工作线程: {args.workers})")
+    server.serve_forever()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
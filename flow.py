@@ -4,18 +4,26 @@ from nodes import (
     GenerateNovelNode,
     ParseNovelNode,
     ValidateNovelNode,
-    SaveNovelNode
+    SaveNovelNode,
+    FinishNode
 )
 
 
-def create_novel_flow():
-    """创建小说生成流程"""
+def create_novel_flow(resume=False):
+    """
+    创建小说生成流程
+
+    Args:
+        resume: 为 True 时从解析节点开始，用于从检查点恢复已生成的响应
+                （shared 中需已有 prompt 和 raw_response）
+    """
     # 创建节点
     build_prompt = BuildPromptNode()
     generate_novel = GenerateNovelNode(max_retries=3, wait=5)
     parse_novel = ParseNovelNode()
     validate_novel = ValidateNovelNode()
     save_novel = SaveNovelNode()
+    finish = FinishNode()
 
     # 连接节点
     build_prompt >> generate_novel >> parse_novel >> validate_novel
@@ -29,9 +37,20 @@ def create_novel_flow():
     # 验证失败则重新生成（可选：也可以直接结束）
     validate_novel - "fail" >> generate_novel
 
+    # 保存前发现其他任务刚保存了相似的小说，重新生成
+    save_novel - "duplicate" >> generate_novel
+
+    # 保存成功后结束
+    save_novel >> finish
+
     # 创建流程
-    return Flow(start=build_prompt)
+    return Flow(start=parse_novel if resume else build_prompt)
 
 
-# 导出流程
-novel_flow = create_novel_flow()
\ No newline at end of file
+def __getattr__(name):
+    # 兼容 from flow import novel_flow：首次访问时才创建流程，导入本模块没有副作用
+    if name == "novel_flow":
+        flow = create_novel_flow()
+        globals()["novel_flow"] = flow
+        return flow
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,5 +1,11 @@
-from flow import novel_flow
+from flow import create_novel_flow
+from utils.yield_stats import YieldStats
+from utils.token_budget import TokenBudget
+from utils.model_policy import ModelPolicy
+from utils.dedup_index import DedupIndex, DEFAULT_INDEX_FILE
+from utils.profiling import profile_job, profiling_enabled
 import json
+import os
 from pathlib import Path
 
 
@@ -23,13 +29,16 @@ def load_config():
     command_dir = Path("config/command")
     if command_dir.exists():
         commands = []
-        for cmd_file in command_dir.glob("*.txt"):
+        command_names = []
+        for cmd_file in sorted(command_dir.glob("*.txt")):
             commands.append(cmd_file.read_text(encoding="utf-8"))
+            command_names.append(cmd_file.name)
     else:
         # 默认命令模板
         commands = [
             "写一个关于{{event}}的故事，要有创意和想象力。",
         ]
+        command_names = ["default"]
 
     # 读取事件库
     events_file = Path("config/events-test.txt")
@@ -42,12 +51,84 @@ def load_config():
     return {
         "tags": tags,
         "commands": commands,
-        "events": events
+        "command_names": command_names,
+        "events": events,
+        # 按历史产出统计加权选择模板和事件（NOVEL_ADAPTIVE_SAMPLING=1 开启）
+        "adaptive_sampling": os.getenv("NOVEL_ADAPTIVE_SAMPLING", "0") == "1",
+        # 推测式生成的并行候选数：1 关闭，整数为固定值，"auto" 按历史失败率选择
+        "speculative_k": parse_speculative_k(os.getenv("NOVEL_SPECULATIVE_K", "1")),
+        # 是否在终端实时打印流式输出（多任务并发时应关闭）
+        "echo_stream": True
     }
 
 
-def main():
-    """主函数"""
+def parse_speculative_k(value):
+    """解析 NOVEL_SPECULATIVE_K 环境变量"""
+    value = value.strip().lower()
+    if value == "auto":
+        return "auto"
+    return max(1, int(value))
+
+
+def print_yield_summary(stats, limit=5):
+    """打印产出最高的模板/事件组合"""
+    rows = stats.summary()
+    if not rows:
+        return
+    print(f"\n产出统计（前 {limit} 个组合，共 {len(rows)} 个）:")
+    for row in rows[:limit]:
+        print(f"  - {row['template']} + {row['event']}: "
+              f"通过 {row['accepted']}/{row['attempts']}，"
+              f"每千 token 通过 {row['accepted_per_1k_tokens']:.4f}")
+
+
+def create_services(stats_dir="output/stats", dedup_path=DEFAULT_INDEX_FILE, journal_mode="WAL"):
+    """
+    创建跨任务共享的统计、预算、模型策略和近重复索引对象
+
+    Args:
+        stats_dir: 统计文件目录（多个进程可以共用，记录时在文件锁内合并）
+        dedup_path: 近重复索引文件（多个进程共用同一个索引，才能发现彼此的重复）
+        journal_mode: 近重复索引的 SQLite 日志模式，多台机器共享网络目录中的索引时使用 "DELETE"
+    """
+    return {
+        "yield_stats": YieldStats(f"{stats_dir}/yield_stats.json"),
+        "token_budget": TokenBudget(model="gemini-2.5-pro"),
+        "model_policy": ModelPolicy(path=f"{stats_dir}/model_stats.json"),
+        # 相似度阈值可通过 NOVEL_DEDUP_THRESHOLD 调整（0~1，默认 0.5）
+        "dedup_index": DedupIndex(dedup_path, threshold=float(os.getenv("NOVEL_DEDUP_THRESHOLD", "0.5")),
+                                  journal_mode=journal_mode)
+    }
+
+
+def create_shared(config, services, job_spec=None):
+    """
+    为一次小说生成创建 shared store
+
+    Args:
+        config: load_config() 返回的配置
+        services: create_services() 返回的共享对象
+        job_spec: 可选，指定模板和事件的任务描述 {"template": ..., "event": ...}
+    """
+    return {
+        "config": config,
+        "job_spec": job_spec or {},
+        "prompt": "",
+        "raw_response": "",
+        "novel": {},
+        "validation": {},
+        "output_files": {},
+        **services
+    }
+
+
+def main(count=1):
+    """
+    主函数
+
+    Args:
+        count: 依次生成的小说数
+    """
     print("=" * 60)
     print("AI 小说自动生成系统 (基于 PocketFlow)")
     print("=" * 60)
@@ -58,35 +139,47 @@ def main():
     print(f"  - 标签数: {len(config['tags'])}")
     print(f"  - 命令模板数: {len(config['commands'])}")
     print(f"  - 事件数: {len(config['events'])}")
+    print(f"  - 自适应采样: {'开启' if config['adaptive_sampling'] else '关闭'}")
+    print(f"  - 推测式候选数: {config['speculative_k']}")
+    print(f"  - 性能分析: {'开启' if profiling_enabled() else '关闭'}")
 
-    # 初始化 shared store
-    shared = {
-        "config": config,
-        "prompt": "",
-        "raw_response": "",
-        "novel": {},
-        "validation": {},
-        "output_files": {}
-    }
+    # 首次启用近重复索引时，先把已保存的小说加入索引
+    services = create_services()
+    dedup_index = services["dedup_index"]
+    if dedup_index.count() == 0:
+        added = dedup_index.index_directory("output/novel")
+        if added:
+            print(f"  - 已为 {added} 本已有小说建立近重复索引")
+    print(f"  - 近重复索引: {dedup_index.count()} 本")
+
+    novel_flow = create_novel_flow()
+    for index in range(count):
+        # 每本小说使用新的 shared store
+        shared = create_shared(config, services)
+
+        # 运行流程
+        progress = f" ({index + 1}/{count})" if count > 1 else ""
+        print(f"\n开始生成小说{progress}...\n")
+        try:
+            # NOVEL_PROFILE=1 时为每本小说写入性能报告
+            with profile_job(shared):
+                novel_flow.run(shared)
+            print("\n" + "=" * 60)
+            print("✓ 小说生成流程完成！")
+            print("=" * 60)
+
+            if shared.get("output_files"):
+                print(f"\n生成的小说: {shared['novel']['title']}")
+                print(f"文件位置:")
+                for key, path in shared["output_files"].items():
+                    print(f"  - {key}: {path}")
+
+        except Exception as e:
+            print(f"\n✗ 生成失败: {e}")
+            import traceback
+            traceback.print_exc()
 
-    # 运行流程
-    print("\n开始生成小说...\n")
-    try:
-        novel_flow.run(shared)
-        print("\n" + "=" * 60)
-        print("✓ 小说生成流程完成！")
-        print("=" * 60)
-
-        if shared.get("output_files"):
-            print(f"\n生成的小说: {shared['novel']['title']}")
-            print(f"文件位置:")
-            for key, path in shared["output_files"].items():
-                print(f"  - {key}: {path}")
-
-    except Exception as e:
-        print(f"\n✗ 生成失败: {e}")
-        import traceback
-        traceback.print_exc()
+    print_yield_summary(services["yield_stats"])
 
 
 if __name__ == "__main__":
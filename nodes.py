@@ -1,55 +1,315 @@
 from pocketflow import Node
 from utils.call_gemini import call_gemini
-from utils.prompt_builder import build_random_prompt
+from utils.speculative import choose_k, first_valid
+from utils.model_policy import ModelPolicy
+from utils.prompt_builder import build_prompt, build_part_prompt
 from utils.novel_parser import parse_novel
 from utils.validator import validate_content, clean_content
+from utils.dedup_index import chapter_text
 import json
+import random
+import time
 from pathlib import Path
 from datetime import datetime
 
 
+def _record_model_outcome(shared, accepted):
+    """
+    记录本次生成所用模型的输出是否通过解析和验证
+
+    分段生成时解析和验证针对整本小说，无法区分各段的贡献：只记录到续写模型，
+    用于判断续写能否交给快速模型；第一段的正文模型不据此计数
+    """
+    policy = shared.get("model_policy")
+    if policy is None:
+        return
+    models = shared.get("generation_models", {})
+    if "continuation" in models:
+        models = {"continuation": models["continuation"]}
+    for task, model in models.items():
+        policy.record_outcome(task, model, accepted)
+
+
+def _duplicate_error(match):
+    """近重复检测的错误信息（"疑似重复" 对应产出统计中的 near_duplicate 类别）"""
+    return f"与已有小说《{match['title']}》相似度 {match['similarity']:.0%}，疑似重复"
+
+
+def _save_error_response(shared):
+    """保存未通过验证的响应到错误目录"""
+    output_dir = Path(shared.get("output_dir", "output"))
+    error_file = output_dir / "errors" / f"error_{shared['novel']['title'][:20]}.txt"
+    error_file.parent.mkdir(parents=True, exist_ok=True)
+    error_file.write_text(shared["raw_response"], encoding="utf-8")
+    print(f"  已保存错误响应到: {error_file}")
+
+
+def _novel_file(shared, title):
+    """小说 JSON 文件的路径，同时作为小说在近重复索引中的引用"""
+    return Path(shared.get("output_dir", "output")) / "novel" / f"{title}.json"
+
+
+def _output_limits(plan):
+    """生成计划给出的输出上限和思考预算（传给 call_gemini），未规划时不限制"""
+    if not plan:
+        return {}
+    return {"max_output_tokens": plan["max_output_tokens"], "thinking_budget": plan.get("thinking_budget")}
+
+
+def _check_lease(shared):
+    """在队列中运行时确认任务租约仍然有效，已丢失时抛出异常中止流程（不在队列中运行时忽略）"""
+    lease = shared.get("lease")
+    if lease is not None:
+        lease.ensure()
+
+
+def _record_stats(shared, method, *args):
+    """将本次任务的解析/验证结果记录到产出统计（未启用统计时忽略）"""
+    job = shared.get("job")
+    stats = shared.get("yield_stats")
+    if job is not None and stats is not None:
+        getattr(stats, method)(job["template"], job["event"], *args)
+
+
 class BuildPromptNode(Node):
     """构建 AI 提示词节点"""
 
     def prep(self, shared):
-        # 读取配置数据
-        return shared["config"]
+        # 读取配置数据、产出统计和 token 预算（后两者可选）
+        return {
+            "config": shared["config"],
+            "stats": shared.get("yield_stats"),
+            "budget": shared.get("token_budget"),
+            "job_spec": shared.get("job_spec") or {}
+        }
+
+    def exec(self, prep_res):
+        config, stats, budget = prep_res["config"], prep_res["stats"], prep_res["budget"]
+        job_spec = prep_res["job_spec"]
+        commands = config["commands"]
+        events = config["events"]
+        template_names = config.get("command_names") or [f"command_{i}" for i in range(len(commands))]
+
+        # 选择命令模板和事件：开启自适应采样时按历史产出加权，否则均匀随机
+        if config.get("adaptive_sampling") and stats is not None:
+            command_index, event = stats.sample_combination(template_names, events)
+        else:
+            command_index = random.randrange(len(commands))
+            event = random.choice(events)
+
+        # 任务描述中指定的模板和事件优先
+        if job_spec.get("template"):
+            if job_spec["template"] not in template_names:
+                raise ValueError(f"未知的命令模板: {job_spec['template']}")
+            command_index = template_names.index(job_spec["template"])
+        if job_spec.get("event"):
+            event = job_spec["event"]
+
+        # 按模型的 token 预算规划章节数和生成方式
+        plan = None
+        if budget is not None:
+            prompt_tokens = budget.prompt_tokens(commands[command_index], event, config["tags"])
+            plan = budget.plan(prompt_tokens)
 
-    def exec(self, config):
         # 调用提示词构建工具
-        prompt = build_random_prompt(
+        prompt_kwargs = {}
+        if plan is not None:
+            prompt_kwargs = {
+                "total_chars": plan["total_chars"],
+                "chapter_chars": plan["chapter_chars"],
+                "chapters": plan["chapters"]
+            }
+        prompt = build_prompt(
+            command=commands[command_index],
+            event=event,
             tags=config["tags"],
-            commands=config["commands"],
-            events=config["events"]
+            **prompt_kwargs
         )
-        return prompt
+        return {"prompt": prompt, "template": template_names[command_index], "event": event, "plan": plan}
 
     def post(self, shared, prep_res, exec_res):
-        # 保存提示词
-        shared["prompt"] = exec_res
-        print(f"✓ 提示词构建完成，长度: {len(exec_res)} 字符")
+        # 保存提示词和生成计划
+        shared["prompt"] = exec_res["prompt"]
+        shared["generation_plan"] = exec_res["plan"]
+
+        # 记录本次任务的归因信息，供后续节点统计
+        shared["job"] = {
+            "template": exec_res["template"],
+            "event": exec_res["event"],
+            "started_at": time.time(),
+            "attempts": 0,
+            "rounds": 0,
+            "tokens": 0
+        }
+        stats = shared.get("yield_stats")
+        if stats is not None:
+            stats.record_job(exec_res["template"], exec_res["event"])
+
+        print(f"✓ 提示词构建完成，长度: {len(exec_res['prompt'])} 字符")
+        print(f"  - 模板: {exec_res['template']}, 事件: {exec_res['event']}")
+        plan = exec_res["plan"]
+        if plan is not None:
+            print(f"  - 生成计划: {plan['mode']}, {plan['chapters']} 章 {plan['total_chars']} 字, "
+                  f"输入 {plan['prompt_tokens']} token, 输出上限 {plan['max_output_tokens']} token")
         return "default"
 
 
 class GenerateNovelNode(Node):
     """调用 Gemini API 生成小说节点"""
 
+    # 推测式生成中解析失败的候选使用此前缀标记错误信息
+    PARSE_ERROR_PREFIX = "解析失败"
+
     def __init__(self, max_retries=3, wait=5):
         super().__init__(max_retries=max_retries, wait=wait)
 
     def prep(self, shared):
-        return shared["prompt"]
+        # 租约丢失后不再发起生成
+        _check_lease(shared)
+        # 推测式生成的候选数：整数为固定值，"auto" 按历史失败率选择
+        k = shared["config"].get("speculative_k", 1)
+        if k == "auto":
+            stats = shared.get("yield_stats")
+            k = choose_k(stats.failure_rate()) if stats is not None else 1
+        return {
+            "prompt": shared["prompt"],
+            "echo": shared["config"].get("echo_stream", True),
+            "k": k,
+            "plan": shared.get("generation_plan"),
+            # 未配置模型策略时使用不持久化的默认策略
+            "policy": shared.get("model_policy") or ModelPolicy(path=None),
+            # 推测式生成检查候选时同时做近重复检测
+            "dedup_index": shared.get("dedup_index")
+        }
+
+    def exec(self, prep_res):
+        plan, policy = prep_res["plan"], prep_res["policy"]
+        limits = _output_limits(plan)
+
+        if plan and plan["mode"] == "split":
+            # 分段生成无法在中途验证整本小说，不使用推测式生成
+            return self._exec_split(prep_res["prompt"], plan, policy, prep_res["echo"])
+        if prep_res["k"] > 1:
+            return self._exec_speculative(prep_res["prompt"], prep_res["k"], policy, limits,
+                                          dedup_index=prep_res["dedup_index"])
 
-    def exec(self, prompt):
         print("调用 Gemini API...开始生成")
-        # 调用 Gemini API（启用流式输出）
-        response = call_gemini(
-            prompt=prompt,
-            temperature=1.2,
-            model="gemini-2.5-pro",
-            stream=True  # 启用流式输出，避免超时
+        start = time.time()
+        usage = {}
+        # 按模型策略调用 Gemini API（启用流式输出）
+        response, model = policy.call(
+            "novel_body",
+            call_gemini,
+            prompt=prep_res["prompt"],
+            stream=True,  # 启用流式输出，避免超时
+            usage=usage,
+            echo=prep_res["echo"],
+            **limits
         )
-        return response
+        return {
+            "text": response,
+            "tokens": usage.get("total_tokens", 0),
+            "seconds": time.time() - start,
+            "attempts": 1,
+            "rejected": [],
+            "models": {"novel_body": model}
+        }
+
+    def _exec_split(self, prompt, plan, policy, echo=True):
+        """按生成计划分段生成，每段在前文基础上继续输出若干章"""
+        parts = plan["parts"]
+        print(f"调用 Gemini API...分 {len(parts)} 段生成")
+        start = time.time()
+        tokens = 0
+        output = ""
+        models = {}
+
+        for index, (start_chapter, end_chapter) in enumerate(parts):
+            print(f"  - 第 {index + 1}/{len(parts)} 段: 第{start_chapter}章到第{end_chapter}章")
+            # 第一段决定标题、设定和文风，使用正文模型；续写段落可由更快的模型完成
+            task = "novel_body" if index == 0 else "continuation"
+            usage = {}
+            part_text, models[task] = policy.call(
+                task,
+                call_gemini,
+                prompt=build_part_prompt(prompt, output, start_chapter, end_chapter,
+                                         is_last=index == len(parts) - 1),
+                stream=True,
+                usage=usage,
+                echo=echo,
+                **_output_limits(plan)
+            )
+            tokens += usage.get("total_tokens", 0)
+            output = f"{output}\n{part_text}" if output else part_text
+
+        return {
+            "text": output,
+            "tokens": tokens,
+            "seconds": time.time() - start,
+            "attempts": 1,
+            "rejected": [],
+            "models": models
+        }
+
+    def _exec_speculative(self, prompt, k, policy, limits=None, dedup_index=None):
+        """并行生成 k 个候选，第一个通过解析、验证和近重复检测的胜出，其余取消"""
+        print(f"调用 Gemini API...推测式生成 {k} 个候选")
+        start = time.time()
+        usages = [{} for _ in range(k)]
+        models = [None] * k
+
+        def generate(index, cancel_event):
+            text, models[index] = policy.call(
+                "novel_body",
+                call_gemini,
+                prompt=prompt,
+                stream=True,
+                usage=usages[index],
+                cancel_event=cancel_event,
+                echo=False,  # 多个候选同时输出会相互穿插
+                **(limits or {})
+            )
+            return text
+
+        outcome = first_valid(generate, lambda response: self._check_candidate(response, dedup_index), k)
+        rejected = outcome["rejected"]
+        if outcome["winner"] is None:
+            # 返回的候选会在解析/验证节点中再次失败并被记录，这里不重复计入
+            result_model = models[rejected[-1][0]]
+            rejected = rejected[:-1]
+            print(f"✗ {k} 个候选均未通过检查")
+        else:
+            result_model = models[outcome["winner"]]
+            print(f"✓ 候选 {outcome['winner']} 胜出，"
+                  f"未通过 {len(outcome['rejected'])} 个，取消 {outcome['cancelled']} 个")
+
+        for index, _, _ in rejected:
+            policy.record_outcome("novel_body", models[index], accepted=False)
+
+        # first_valid 返回前已等待被取消的候选退出，usages 包含它们已消耗的 token
+        if outcome["pending"]:
+            print(f"⚠ {outcome['pending']} 个被取消的候选未能及时退出，其 token 用量未计入")
+        return {
+            "text": outcome["result"],
+            "tokens": sum(u.get("total_tokens", 0) for u in usages),
+            "seconds": time.time() - start,
+            "attempts": k - outcome["cancelled"],
+            "rejected": [errors for _, _, errors in rejected],
+            "models": {"novel_body": result_model}
+        }
+
+    def _check_candidate(self, response, dedup_index=None):
+        """检查候选能否通过解析、验证和近重复检测（与 ValidateNovelNode 一致），返回错误列表"""
+        try:
+            novel = parse_novel(response)
+        except ValueError as e:
+            return [f"{self.PARSE_ERROR_PREFIX}: {e}"]
+        _, errors = validate_content(novel["content"])
+        if dedup_index is not None and not errors:
+            matches = dedup_index.query(dedup_index.signature(chapter_text(novel)))
+            if matches:
+                errors.append(_duplicate_error(matches[0]))
+        return errors
 
     def exec_fallback(self, prep_res, exc):
         # 失败时的降级处理
@@ -57,8 +317,32 @@ class GenerateNovelNode(Node):
         raise exc  # 重新抛出异常，让上层处理
 
     def post(self, shared, prep_res, exec_res):
-        shared["raw_response"] = exec_res
-        print(f"✓ 小说生成完成，响应长度: {len(exec_res)} 字符")
+        shared["raw_response"] = exec_res["text"]
+        shared["generation_models"] = exec_res["models"]
+
+        # 累计本次任务的生成次数和 token 消耗
+        job = shared.get("job")
+        if job is not None:
+            job["attempts"] += exec_res["attempts"]
+            job["rounds"] += 1
+            job["tokens"] += exec_res["tokens"]
+            stats = shared.get("yield_stats")
+            if stats is not None:
+                stats.record_attempt(job["template"], job["event"], tokens=exec_res["tokens"],
+                                     seconds=exec_res["seconds"], count=exec_res["attempts"])
+            # 推测式生成中未通过的候选
+            for errors in exec_res["rejected"]:
+                if errors[0].startswith(self.PARSE_ERROR_PREFIX):
+                    _record_stats(shared, "record_parse_failure")
+                else:
+                    _record_stats(shared, "record_validation_failure", errors)
+
+        # 在队列中运行时立即保存检查点，进程崩溃后接手的进程不必重新生成
+        lease = shared.get("lease")
+        if lease is not None:
+            lease.checkpoint(shared)
+
+        print(f"✓ 小说生成完成，响应长度: {len(exec_res['text'])} 字符")
         return "default"
 
 
@@ -82,10 +366,14 @@ class ParseNovelNode(Node):
     def post(self, shared, prep_res, exec_res):
         # 检查解析是否成功
         if exec_res is None:
+            _record_stats(shared, "record_parse_failure")
+            _record_model_outcome(shared, accepted=False)
             print("✗ 解析失败，准备重新生成小说...")
             return "retry"
 
         shared["novel"] = exec_res
+        # 每次生成选择的标签都计入统计，未通过验证的生成也能归因到标签
+        _record_stats(shared, "record_tags", exec_res["tags"])
         print(f"✓ 小说解析成功: {exec_res['title']}")
         # 修复 f-string 语法错误：先构建标签列表，再插入
         tags_str = [f"{t['label']}-{t['name']}" for t in exec_res['tags']]
@@ -98,15 +386,37 @@ class ValidateNovelNode(Node):
     """验证小说质量节点"""
 
     def prep(self, shared):
-        return shared["novel"]["content"]
+        # 近重复索引可选，未启用时只做内容验证
+        return {
+            "content": shared["novel"]["content"],
+            "chapter_text": chapter_text(shared["novel"]),
+            "index": shared.get("dedup_index"),
+            # 从检查点恢复时，崩溃前保存的同一本小说可能已在索引中，不能算作重复
+            "ref": str(_novel_file(shared, shared["novel"]["title"])),
+        }
 
-    def exec(self, content):
+    def exec(self, prep_res):
         # 验证内容
-        passed, errors = validate_content(content)
-        return {"passed": passed, "errors": errors}
+        passed, errors = validate_content(prep_res["content"])
+
+        # 与已保存的小说比较章节正文，相似度超过阈值视为重复
+        index = prep_res["index"]
+        signature = None
+        if index is not None:
+            signature = index.signature(prep_res["chapter_text"])
+            matches = index.query(signature, exclude_ref=prep_res["ref"])
+            if matches:
+                passed = False
+                errors.append(_duplicate_error(matches[0]))
+
+        return {"passed": passed, "errors": errors, "signature": signature}
 
     def post(self, shared, prep_res, exec_res):
-        shared["validation"] = exec_res
+        # 签名留给 SaveNovelNode 加入索引，避免重复计算
+        shared["dedup_signature"] = exec_res["signature"]
+        shared["validation"] = {"passed": exec_res["passed"], "errors": exec_res["errors"]}
+
+        _record_model_outcome(shared, accepted=exec_res["passed"])
 
         if exec_res["passed"]:
             print("✓ 小说验证通过")
@@ -115,13 +425,8 @@ class ValidateNovelNode(Node):
             print("✗ 小说验证失败:")
             for error in exec_res["errors"]:
                 print(f"  - {error}")
-
-            # 保存失败的响应到错误目录
-            error_file = Path("output/errors") / f"error_{shared['novel']['title'][:20]}.txt"
-            error_file.parent.mkdir(parents=True, exist_ok=True)
-            error_file.write_text(shared["raw_response"], encoding="utf-8")
-            print(f"  已保存错误响应到: {error_file}")
-
+            _record_stats(shared, "record_validation_failure", exec_res["errors"])
+            _save_error_response(shared)
             return "fail"
 
 
@@ -129,6 +434,8 @@ class SaveNovelNode(Node):
     """保存小说到本地文件节点"""
 
     def prep(self, shared):
+        # 租约丢失后任务已属于其他进程，不再保存
+        _check_lease(shared)
         return shared["novel"]
 
     def exec(self, novel):
@@ -170,22 +477,36 @@ class SaveNovelNode(Node):
 
     def post(self, shared, prep_res, exec_res):
         title = exec_res["title"]
+        output_dir = Path(shared.get("output_dir", "output"))
+        json_file = _novel_file(shared, title)                  # JSON 数据
+
+        # 写入文件前加入近重复索引：检查和写入是原子的，验证之后其他任务保存的相似小说也能发现
+        index = shared.get("dedup_index")
+        signature = shared.get("dedup_signature")
+        if index is not None and signature is not None:
+            duplicate = index.add_if_unique(title, signature, ref=str(json_file))
+            if duplicate is not None:
+                error = _duplicate_error(duplicate)
+                shared["validation"] = {"passed": False, "errors": [error]}
+                print(f"✗ 保存前发现重复: {error}")
+                _record_stats(shared, "record_validation_failure", [error])
+                _save_error_response(shared)
+                return "duplicate"
 
         # 确保输出目录存在
-        Path("output").mkdir(exist_ok=True)
-        Path("output/intro").mkdir(exist_ok=True)
-        Path("output/novel").mkdir(exist_ok=True)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        (output_dir / "intro").mkdir(exist_ok=True)
+        (output_dir / "novel").mkdir(exist_ok=True)
 
         # 为 full 目录创建时间戳子目录
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        full_dir = Path("output/full") / timestamp
+        full_dir = output_dir / "full" / timestamp
         full_dir.mkdir(parents=True, exist_ok=True)
 
         # 保存文件
-        content_file = Path("output") / f"{title}.txt"          # HTML 格式（平台粘贴用）
-        intro_file = Path("output/intro") / f"{title}.txt"      # 标签+简介
+        content_file = output_dir / f"{title}.txt"              # HTML 格式（平台粘贴用）
+        intro_file = output_dir / "intro" / f"{title}.txt"      # 标签+简介
         full_file = full_dir / f"{title}.txt"                   # 完整格式（阅读用）- 保存到时间戳目录
-        json_file = Path("output/novel") / f"{title}.json"      # JSON 数据
 
         content_file.write_text(exec_res["html_content"], encoding="utf-8")
         intro_file.write_text(exec_res["intro_content"], encoding="utf-8")
@@ -200,10 +521,26 @@ class SaveNovelNode(Node):
             "json": str(json_file)
         }
 
+        # 记录通过的小说
+        job = shared.get("job")
+        stats = shared.get("yield_stats")
+        if job is not None and stats is not None:
+            stats.record_accept(
+                job["template"], job["event"], shared["novel"]["tags"],
+                seconds=time.time() - job["started_at"], attempts=job["rounds"]
+            )
+
         print(f"✓ 小说已保存:")
         print(f"  - 平台格式: {content_file}")
         print(f"  - 完整格式: {full_file}")
         print(f"  - 简介: {intro_file}")
         print(f"  - JSON: {json_file}")
 
-        return "default"
\ No newline at end of file
+        return "default"
+
+
+class FinishNode(Node):
+    """流程结束节点：SaveNovelNode 还有 "duplicate" 后继，保存成功时需要显式的后继结束流程"""
+
+    def post(self, shared, prep_res, exec_res):
+        return None
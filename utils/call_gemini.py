@@ -3,26 +3,37 @@ Gemini API 调用工具
 使用官方 Google Generative AI SDK
 """
 import os
-from google import genai
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from google import genai
 
 # 在初始化之前设置代理
 # 如果需要使用代理，取消下面的注释并修改端口
 # os.environ['http_proxy'] = 'http://127.0.0.1:15236'
 # os.environ['https_proxy'] = 'http://127.0.0.1:15236'
 
-def call_gemini(prompt: str, temperature: float = 1.0, model: str = "gemini-2.5-pro", stream: bool = True) -> str:
-    """
-    调用 Google Gemini API 生成内容（支持流式输出）
 
-    Args:
-        prompt: 提示词
-        temperature: 温度参数，控制创造性 (0.0-2.0)
-        model: 模型名称
-        stream: 是否使用流式输出
+# 按 API Key 缓存的客户端，长时间运行的进程（守护进程）复用同一连接池
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class GenerationCancelled(Exception):
+    """流式生成被调用方通过 cancel_event 取消"""
+
+
+def _get_client() -> "genai.Client":
+    """检查代理和 API Key 并返回 Gemini 客户端（同一 API Key 只创建一次）"""
+    # SDK 导入耗时较长，延迟到第一次调用 API 时再导入，不调用 API 的命令不受影响
+    from google import genai
+
+    api_key = os.getenv("GEMINI_API_KEY", "")
+    with _clients_lock:
+        if api_key and api_key in _clients:
+            return _clients[api_key]
 
-    Returns:
-        生成的文本内容
-    """
     # 检测代理设置
     proxy = os.getenv("HTTP_PROXY") or os.getenv("http_proxy")
     print(f"🌐 当前代理: {proxy if proxy else '未设置'}")
@@ -35,29 +46,86 @@ def call_gemini(prompt: str, temperature: float = 1.0, model: str = "gemini-2.5-
         os.environ['http_proxy'] = default_proxy
         os.environ['https_proxy'] = default_proxy
 
-    # 获取 API Key
-    api_key = os.getenv("GEMINI_API_KEY", "")
+    # 检查 API Key
     if not api_key:
         raise ValueError("GEMINI_API_KEY 环境变量未设置")
 
     print(f"✓ API Key: {api_key[:10]}...{api_key[-4:]}")
 
-    try:
-        client = genai.Client(api_key=api_key)
+    with _clients_lock:
+        return _clients.setdefault(api_key, genai.Client(api_key=api_key))
+
+
+def count_tokens(text: str, model: str = "gemini-2.5-pro") -> int:
+    """
+    调用 Gemini API 统计文本的输入 token 数
+
+    Args:
+        text: 待统计文本
+        model: 模型名称（不同模型的分词器可能不同）
+
+    Returns:
+        token 数
+    """
+    response = _get_client().models.count_tokens(model=model, contents=text)
+    return response.total_tokens
+
+
+def call_gemini(prompt: str, temperature: float = 1.0, model: str = "gemini-2.5-pro", stream: bool = True,
+                usage: dict | None = None, cancel_event: threading.Event | None = None,
+                echo: bool = True, max_output_tokens: int | None = None,
+                thinking_budget: int | None = None) -> str:
+    """
+    调用 Google Gemini API 生成内容（支持流式输出）
 
+    Args:
+        prompt: 提示词
+        temperature: 温度参数，控制创造性 (0.0-2.0)
+        model: 模型名称
+        stream: 是否使用流式输出
+        usage: 可选，传入一个字典用于接收本次调用的 token 用量
+               (prompt_tokens, output_tokens, total_tokens)
+        cancel_event: 可选，流式生成时每个 chunk 检查一次，被设置后中止生成
+                      并抛出 GenerationCancelled
+        echo: 是否将流式输出实时打印到终端（并行生成时应关闭）
+        max_output_tokens: 可选，输出 token 上限（含思考 token）
+        thinking_budget: 可选，思考 token 上限；设置 max_output_tokens 时应一起设置，
+                         否则动态思考可能占满输出上限导致正文被截断
+
+    Returns:
+        生成的文本内容
+    """
+    client = _get_client()
+
+    generate_config = {"temperature": temperature}
+    if max_output_tokens:
+        generate_config["max_output_tokens"] = max_output_tokens
+    if thinking_budget is not None:
+        generate_config["thinking_config"] = {"thinking_budget": thinking_budget}
+
+    try:
         if stream:
             # 流式输出
             print("📡 开始流式生成...")
             full_text = ""
+            usage_metadata = None
             for chunk in client.models.generate_content_stream(
                 model=model,
                 contents=prompt,
-                config={"temperature": temperature}
+                config=generate_config
             ):
-                text = chunk.text
-                print(text, end='', flush=True)
+                text = chunk.text or ""
+                if echo:
+                    print(text, end='', flush=True)
                 full_text += text
+                # 流式响应的用量信息在最后的 chunk 中最完整
+                if getattr(chunk, "usage_metadata", None):
+                    usage_metadata = chunk.usage_metadata
+                if cancel_event is not None and cancel_event.is_set():
+                    _fill_usage(usage, usage_metadata)
+                    raise GenerationCancelled(f"生成已取消，已输出 {len(full_text)} 字符")
             print("\n✓ 生成完成")
+            _fill_usage(usage, usage_metadata)
             return full_text
         else:
             # 普通输出
@@ -65,11 +133,14 @@ def call_gemini(prompt: str, temperature: float = 1.0, model: str = "gemini-2.5-
             response = client.models.generate_content(
                 model=model,
                 contents=prompt,
-                config={"temperature": temperature}
+                config=generate_config
             )
             print("✓ 生成完成")
+            _fill_usage(usage, getattr(response, "usage_metadata", None))
             return response.text
 
+    except GenerationCancelled:
+        raise
     except Exception as e:
         print(f"\n✗ Gemini API 调用失败")
         print(f"   错误: {e}")
@@ -81,6 +152,18 @@ def call_gemini(prompt: str, temperature: float = 1.0, model: str = "gemini-2.5-
         raise
 
 
+def _fill_usage(usage: dict | None, usage_metadata) -> None:
+    """将 SDK 返回的 usage_metadata 写入调用方提供的字典"""
+    if usage is None or usage_metadata is None:
+        return
+    prompt_tokens = getattr(usage_metadata, "prompt_token_count", None) or 0
+    total_tokens = getattr(usage_metadata, "total_token_count", None) or 0
+    usage["prompt_tokens"] = prompt_tokens
+    # 输出 token 包含思考 token，按 total - prompt 计算
+    usage["output_tokens"] = max(total_tokens - prompt_tokens, 0)
+    usage["total_tokens"] = total_tokens
+
+
 if __name__ == "__main__":
     # 测试代码
     test_prompt = "写一个 100 字的科幻小说开头"
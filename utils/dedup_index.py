@@ -0,0 +1,362 @@
+"""
+近重复检测工具
+对章节正文计算 MinHash 签名，用 LSH 分桶索引保存在 SQLite 中，
+可以在不遍历全部历史小说的情况下找出与新小说高度相似的已有作品，
+内存占用与索引规模无关，适用于 10 万本以上的语料
+
+与任务队列相同，默认的 WAL 模式只适用于同一台机器上的多个进程，
+多台机器通过网络目录共享索引时使用 journal_mode="DELETE"（见 utils/work_queue.py）
+"""
+import hashlib
+import json
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+from pathlib import Path
+
+
+DEFAULT_INDEX_FILE = "output/dedup/index.db"
+
+# MinHash 使用的梅森素数 2^61 - 1
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 61) - 1
+
+# 计算 shingle 前去掉空白和标点，只比较文字本身
+_STRIP_PATTERN = re.compile(r'[\s\.,;!?:，。；！？：、"“”‘’\'（）\(\)\[\]【】《》…—\-]+')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS novels (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    title      TEXT NOT NULL,
+    ref        TEXT,
+    signature  BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bands (
+    band     INTEGER NOT NULL,
+    bucket   INTEGER NOT NULL,
+    novel_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_bands ON bands (band, bucket);
+CREATE INDEX IF NOT EXISTS idx_novels_ref ON novels (ref);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def choose_bands(num_perm: int, threshold: float) -> tuple[int, int]:
+    """
+    选择 LSH 的分段数和每段行数，使候选阈值 (1/b)^(1/r) 最接近且不高于相似度阈值
+
+    Args:
+        num_perm: MinHash 排列数
+        threshold: 相似度阈值
+
+    Returns:
+        (分段数 b, 每段行数 r)
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        candidate_threshold = (1 / bands) ** (1 / rows)
+        # 候选阈值略低于判定阈值，减少漏检
+        if candidate_threshold > threshold:
+            continue
+        if best is None or candidate_threshold > best[2]:
+            best = (bands, rows, candidate_threshold)
+    if best is None:
+        return num_perm, 1
+    return best[0], best[1]
+
+
+class DedupIndex:
+    """基于 MinHash + LSH 的小说近重复索引"""
+
+    def __init__(self, path: str = DEFAULT_INDEX_FILE, threshold: float = 0.5, num_perm: int = 128,
+                 shingle_size: int = 5, seed: int = 20240601, journal_mode: str = "WAL"):
+        """
+        Args:
+            path: 索引数据库路径
+            threshold: 判定为近重复的相似度（Jaccard）阈值，新建索引时也据此选择 LSH 分段方式
+            num_perm: MinHash 排列数，越大估计越准确
+            shingle_size: 字符 shingle 长度
+            seed: 生成排列参数的随机种子（同一索引必须保持不变）
+            journal_mode: "WAL"（单机多进程）或 "DELETE"（多台机器共享网络目录），
+                          与 utils/work_queue.py 相同，同一索引的所有进程必须使用相同的模式
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+        # 守护进程中多个线程共享同一索引
+        self._lock = threading.Lock()
+        self.journal_mode = journal_mode.upper()
+        self.conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # 其他进程仍以另一种模式打开索引时无法切换（返回原模式或数据库被锁），此时拒绝使用
+        try:
+            mode = self.conn.execute(f"PRAGMA journal_mode={self.journal_mode}").fetchone()[0]
+        except sqlite3.OperationalError as e:
+            mode = f"未知: {e}"
+        if mode.upper() != self.journal_mode:
+            self.conn.close()
+            raise RuntimeError(f"无法将 {self.path} 切换为 {self.journal_mode} 模式（当前为 {mode}），"
+                               f"请先停止以其他模式运行的进程")
+        self.conn.executescript(SCHEMA)
+        self.bands, self.rows = self._load_params(seed)
+
+    def _load_params(self, seed):
+        """
+        读取索引的签名参数；新索引按阈值选择分段方式并写入
+
+        分段方式创建后固定，之后调整 threshold 不影响已有索引；
+        签名参数不一致时拒绝使用（否则签名无法比较）
+        """
+        signature_params = {"num_perm": self.num_perm, "shingle_size": self.shingle_size, "seed": seed}
+        with self.conn:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+            if row is None:
+                bands, rows = choose_bands(self.num_perm, self.threshold)
+                params = {**signature_params, "bands": bands, "rows": rows}
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('params', ?)", (json.dumps(params),))
+                return bands, rows
+
+        params = json.loads(row[0])
+        if {key: params[key] for key in signature_params} != signature_params:
+            raise ValueError(f"索引参数不一致: 已有 {params}，当前 {signature_params}")
+        return params["bands"], params["rows"]
+
+    def close(self):
+        self.conn.close()
+
+    def signature(self, text: str) -> list[int]:
+        """
+        计算文本的 MinHash 签名
+
+        Args:
+            text: 正文文本
+
+        Returns:
+            长度为 num_perm 的签名
+        """
+        text = _STRIP_PATTERN.sub("", text)
+        size = self.shingle_size
+        shingles = {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") & _MAX_HASH
+            for s in shingles
+        ]
+        return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in self._perms]
+
+    def _buckets(self, signature: list[int]) -> list[int]:
+        """每个分段的桶编号（分段内签名值的哈希）"""
+        buckets = []
+        for band in range(self.bands):
+            chunk = signature[band * self.rows:(band + 1) * self.rows]
+            digest = hashlib.blake2b(struct.pack(f"<{len(chunk)}Q", *chunk), digest_size=8).digest()
+            # SQLite INTEGER 为有符号 64 位
+            buckets.append(int.from_bytes(digest, "little", signed=True))
+        return buckets
+
+    @staticmethod
+    def similarity(sig_a: list[int], sig_b: list[int]) -> float:
+        """两个签名估计的 Jaccard 相似度"""
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+    def _matches(self, signature: list[int], buckets: list[int], threshold: float) -> list[dict]:
+        """查找同桶且相似度不低于阈值的已有小说（调用方需持有实例锁）"""
+        candidate_ids = set()
+        for band, bucket in enumerate(buckets):
+            rows = self.conn.execute(
+                "SELECT novel_id FROM bands WHERE band = ? AND bucket = ?", (band, bucket)
+            ).fetchall()
+            candidate_ids.update(row[0] for row in rows)
+
+        matches = []
+        for novel_id in candidate_ids:
+            title, ref, blob = self.conn.execute(
+                "SELECT title, ref, signature FROM novels WHERE id = ?", (novel_id,)
+            ).fetchone()
+            score = self.similarity(signature, array("Q", blob).tolist())
+            if score >= threshold:
+                matches.append({"title": title, "ref": ref, "similarity": score})
+
+        matches.sort(key=lambda m: m["similarity"], reverse=True)
+        return matches
+
+    def _insert(self, title: str, signature: list[int], buckets: list[int], ref: str | None) -> int:
+        """写入小说及其分桶（调用方需持有实例锁并处于事务中）"""
+        cursor = self.conn.execute(
+            "INSERT INTO novels (title, ref, signature, created_at) VALUES (?, ?, ?, ?)",
+            (title, ref, array("Q", signature).tobytes(), time.time())
+        )
+        novel_id = cursor.lastrowid
+        self.conn.executemany(
+            "INSERT INTO bands (band, bucket, novel_id) VALUES (?, ?, ?)",
+            [(band, bucket, novel_id) for band, bucket in enumerate(buckets)]
+        )
+        return novel_id
+
+    def query(self, signature: list[int], threshold: float | None = None,
+              exclude_ref: str | None = None) -> list[dict]:
+        """
+        查找与签名相似度不低于阈值的已有小说
+
+        Args:
+            signature: 待查询小说的签名
+            threshold: 相似度阈值，默认使用索引的阈值
+            exclude_ref: 可选，忽略引用为此值的小说（待查询的小说本身已加入索引时，如从检查点恢复）
+
+        Returns:
+            [{"title", "ref", "similarity"}, ...]，按相似度降序
+        """
+        threshold = self.threshold if threshold is None else threshold
+        buckets = self._buckets(signature)
+        with self._lock:
+            matches = self._matches(signature, buckets, threshold)
+        if exclude_ref is not None:
+            matches = [match for match in matches if match["ref"] != exclude_ref]
+        return matches
+
+    def add(self, title: str, signature: list[int], ref: str | None = None) -> int:
+        """
+        将小说加入索引（不检查重复）
+
+        Args:
+            title: 小说标题
+            signature: MinHash 签名
+            ref: 可选，小说文件路径等引用信息
+
+        Returns:
+            索引中的 ID
+        """
+        buckets = self._buckets(signature)
+        with self._lock, self.conn:
+            return self._insert(title, signature, buckets, ref)
+
+    def add_if_unique(self, title: str, signature: list[int], ref: str | None = None) -> dict | None:
+        """
+        没有近重复的已有小说时将小说加入索引，查询和写入在同一个写事务中完成
+
+        多个线程或进程同时保存相似的小说时只有一个能加入索引，其余的会看到先加入的小说。
+        相似的已有小说引用同一个 ref 时视为同一本小说已经加入过（如从检查点恢复后重新保存），不重复写入
+
+        Args:
+            title: 小说标题
+            signature: MinHash 签名
+            ref: 可选，小说文件路径等引用信息
+
+        Returns:
+            相似度最高的已有小说 {"title", "ref", "similarity"}，没有重复（已加入索引）时返回 None
+        """
+        buckets = self._buckets(signature)
+        with self._lock, self.conn:
+            # BEGIN IMMEDIATE 取得写锁，其他进程的查询-写入在此之后才能进行
+            self.conn.execute("BEGIN IMMEDIATE")
+            matches = self._matches(signature, buckets, self.threshold)
+            if any(match["ref"] == ref for match in matches if ref is not None):
+                return None
+            if matches:
+                return matches[0]
+            self._insert(title, signature, buckets, ref)
+        return None
+
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM novels").fetchone()[0]
+
+    def index_directory(self, novel_dir: str = "output/novel") -> int:
+        """
+        将已有的 JSON 小说文件（SaveNovelNode 的输出）加入索引，用于首次建立索引
+
+        Returns:
+            新加入的小说数
+        """
+        added = 0
+        for json_file in sorted(Path(novel_dir).glob("*.json")):
+            with self._lock:
+                known = self.conn.execute(
+                    "SELECT 1 FROM novels WHERE ref = ?", (str(json_file),)
+                ).fetchone()
+            if known:
+                continue
+            novel = json.loads(json_file.read_text(encoding="utf-8"))
+            self.add(novel["title"], self.signature(chapter_text(novel)), ref=str(json_file))
+            added += 1
+        return added
+
+
+def chapter_text(novel: dict) -> str:
+    """拼接小说的章节正文（不含章节标题），用于计算签名"""
+    if novel.get("chapters"):
+        return "\n".join(chapter["content"] for chapter in novel["chapters"])
+    return novel.get("content", "")
+
+
+if __name__ == "__main__":
+    # 测试代码
+    import tempfile
+
+    def random_text(seed, alphabet, length=9000):
+        rng = random.Random(seed)
+        return "".join(rng.choice(alphabet) for _ in range(length))
+
+    base = random_text(1, "天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏闰余成岁律吕调阳云腾致雨露结为霜")
+    different = random_text(3, "剑号巨阙珠称夜光果珍李柰菜重芥姜海咸河淡鳞潜羽翔龙师火帝鸟官人皇")
+    # 近似副本：改动约 3% 的字符
+    rng = random.Random(2)
+    near_copy = "".join(rng.choice("金生丽水玉出昆冈") if rng.random() < 0.03 else c for c in base)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = DedupIndex(Path(tmp_dir) / "index.db", threshold=0.5)
+        print(f"LSH 参数: {index.bands} 段 x {index.rows} 行")
+
+        start = time.time()
+        base_sig = index.signature(base)
+        print(f"签名耗时: {time.time() - start:.2f}s ({len(base)} 字)")
+        index.add("原作", base_sig)
+        index.add("无关小说", index.signature(different))
+
+        near_matches = index.query(index.signature(near_copy))
+        print(f"近似副本: {near_matches}")
+        unrelated_matches = index.query(index.signature(random_text(4, "天地玄黄宇宙洪荒日月盈昃辰宿列张")))
+        print(f"无关文本: {unrelated_matches}")
+        assert near_matches and near_matches[0]["title"] == "原作"
+        assert not unrelated_matches
+
+        # 重新打开索引时沿用已有的分段方式，阈值可以单独调整
+        reopened = DedupIndex(Path(tmp_dir) / "index.db", threshold=0.8)
+        assert (reopened.bands, reopened.rows) == (index.bands, index.rows)
+        assert reopened.count() == 2 and not reopened.query(index.signature(near_copy))
+
+        # 查询和写入是原子的：同时保存的两本近似小说只有一本加入索引
+        near_sig = index.signature(near_copy)
+        assert index.add_if_unique("近似副本", near_sig)["title"] == "原作"
+        fresh_sig = index.signature(random_text(5, "寸阴是竞资父事君曰严与敬孝当竭力忠则尽命临深履薄"))
+        assert index.add_if_unique("新作", fresh_sig, ref="novel/新作.json") is None
+        assert index.add_if_unique("新作（重新保存）", fresh_sig, ref="novel/新作.json") is None
+        assert index.add_if_unique("新作副本", fresh_sig, ref="novel/新作副本.json")["title"] == "新作"
+        assert not index.query(fresh_sig, exclude_ref="novel/新作.json")
+
+        # 多台机器共享网络目录时使用回滚日志模式
+        rollback = DedupIndex(Path(tmp_dir) / "rollback.db", journal_mode="DELETE")
+        rollback.add("原作", base_sig, ref="novel/原作.json")
+        assert rollback.add_if_unique("近似副本", near_sig)["title"] == "原作"
+        assert rollback.conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+        assert index.count() == 3
+        print("[OK] 近重复检测正常")
@@ -0,0 +1,229 @@
+"""
+模型分级策略工具
+按任务类型选择模型和温度：辅助任务优先使用更快的模型，只有在其验证通过率
+明显低于参考模型时才退回 pro 模型；同时记录每个模型的延迟和通过率。
+参考模型按 explore_rate 的概率被排在首位，保证它也持续积累样本，通过率才有可比的基准。
+统计文件通过 utils/stats_file.py 读写
+"""
+import random
+import threading
+import time
+from pathlib import Path
+
+from utils.stats_file import add_counts, merge_counts, read_section
+
+
+DEFAULT_MODEL_STATS_FILE = "output/stats/model_stats.json"
+
+# 任务类型 -> 候选模型（按优先顺序，最后一个为参考模型，也是调用失败时的最终回退）
+TASK_POLICIES = {
+    # 小说正文：保留给 pro 模型
+    "novel_body": [
+        {"model": "gemini-2.5-pro", "temperature": 1.2},
+    ],
+    # 分段生成中的续写段落
+    "continuation": [
+        {"model": "gemini-2.5-flash", "temperature": 1.2},
+        {"model": "gemini-2.5-pro", "temperature": 1.2},
+    ],
+    # 章节改写、格式修复
+    "repair": [
+        {"model": "gemini-2.5-flash", "temperature": 0.7},
+        {"model": "gemini-2.5-pro", "temperature": 0.7},
+    ],
+    # 标题、简介等短文本
+    "short": [
+        {"model": "gemini-2.5-flash-lite", "temperature": 1.0},
+        {"model": "gemini-2.5-flash", "temperature": 1.0},
+    ],
+}
+
+
+def _empty_model_record() -> dict:
+    return {
+        "calls": 0,           # 成功返回的调用次数
+        "errors": 0,          # 调用异常次数
+        "seconds": 0.0,       # 成功调用的累计耗时
+        "accepted": 0,        # 结果通过验证的次数
+        "rejected": 0,        # 结果未通过解析或验证的次数
+    }
+
+
+class ModelPolicy:
+    """按任务类型选择模型，并根据观测到的延迟和通过率调整"""
+
+    def __init__(self, policies: dict = None, path: str | None = DEFAULT_MODEL_STATS_FILE,
+                 min_samples: int = 5, tolerance: float = 0.1, explore_rate: float = 0.1,
+                 rng: random.Random | None = None):
+        """
+        Args:
+            policies: 任务策略，默认使用 TASK_POLICIES
+            path: 统计文件路径，为 None 时只保存在内存中
+            min_samples: 判断通过率前每个模型至少需要的验证样本数
+            tolerance: 快速模型的通过率可以比参考模型低多少仍被优先使用
+            explore_rate: 有多个候选模型时，把参考模型排在首位的概率（用于积累参考模型的样本）
+            rng: 可选，探索使用的随机数生成器
+        """
+        self.policies = policies or TASK_POLICIES
+        self.path = Path(path) if path else None
+        self.min_samples = min_samples
+        self.tolerance = tolerance
+        self.explore_rate = explore_rate
+        self.rng = rng or random.Random()
+        self.stats = {}
+        # 推测式生成时多个候选在不同线程中并发记录
+        self._lock = threading.Lock()
+        if self.path is not None:
+            self.stats = read_section(self.path, "tasks")
+
+    def _update(self, task: str, model: str, **increments):
+        """累加统计字段并合并写入文件，同时刷新内存中的统计（包括其他进程记录的数据）"""
+        with self._lock:
+            add_counts(self.stats.setdefault(task, {}).setdefault(model, _empty_model_record()), increments)
+            if self.path is not None:
+                # 增量包含所有字段，文件中新出现的模型记录也是完整的
+                delta = {**_empty_model_record(), **increments}
+                self.stats = merge_counts(self.path, "tasks", {task: {model: delta}})
+
+    def acceptance_rate(self, task: str, model: str) -> float | None:
+        """模型在该任务上的验证通过率，样本不足时返回 None"""
+        record = self.stats.get(task, {}).get(model)
+        if record is None:
+            return None
+        samples = record["accepted"] + record["rejected"]
+        if samples < self.min_samples:
+            return None
+        return record["accepted"] / samples
+
+    def average_latency(self, task: str, model: str) -> float | None:
+        """模型在该任务上的平均耗时（秒）"""
+        record = self.stats.get(task, {}).get(model)
+        if record is None or record["calls"] == 0:
+            return None
+        return record["seconds"] / record["calls"]
+
+    def options(self, task: str) -> list[dict]:
+        """
+        返回该任务的候选模型，按调用顺序排列（第一个为首选，其余为失败时的回退）
+
+        快速模型在样本不足时先试用；样本足够后，通过率不低于参考模型减去 tolerance 才保持首选，
+        否则排到参考模型之后。参考模型只有被调用才有样本，因此按 explore_rate 的概率
+        直接把参考模型排在首位
+
+        Args:
+            task: 任务类型
+
+        Returns:
+            [{"model": ..., "temperature": ...}, ...]
+        """
+        if task not in self.policies:
+            raise ValueError(f"未知的任务类型: {task}")
+
+        options = self.policies[task]
+        reference = options[-1]
+        if len(options) > 1 and self.rng.random() < self.explore_rate:
+            return [reference] + options[:-1]
+        reference_rate = self.acceptance_rate(task, reference["model"])
+
+        preferred, demoted = [], []
+        for option in options[:-1]:
+            rate = self.acceptance_rate(task, option["model"])
+            if rate is None or reference_rate is None or rate >= reference_rate - self.tolerance:
+                preferred.append(option)
+            else:
+                demoted.append(option)
+        return preferred + [reference] + demoted
+
+    def call(self, task: str, call_fn, **kwargs) -> tuple[str, str]:
+        """
+        按策略调用模型，调用异常时依次回退到下一个候选模型
+
+        Args:
+            task: 任务类型
+            call_fn: 调用函数，接受 model 和 temperature 关键字参数（如 call_gemini）
+            **kwargs: 传给 call_fn 的其余参数
+
+        Returns:
+            (生成的文本, 实际使用的模型)
+        """
+        options = self.options(task)
+        for index, option in enumerate(options):
+            start = time.time()
+            try:
+                text = call_fn(model=option["model"], temperature=option["temperature"], **kwargs)
+            except Exception:
+                # 调用方主动取消（如推测式生成的落选候选）不计入错误，也不回退
+                cancel_event = kwargs.get("cancel_event")
+                if cancel_event is not None and cancel_event.is_set():
+                    raise
+                self._update(task, option["model"], errors=1)
+                if index == len(options) - 1:
+                    raise
+                print(f"⚠️  {option['model']} 调用失败，回退到 {options[index + 1]['model']}")
+                continue
+
+            self._update(task, option["model"], calls=1, seconds=time.time() - start)
+            return text, option["model"]
+
+    def record_outcome(self, task: str, model: str, accepted: bool):
+        """记录模型输出是否通过解析和验证"""
+        self._update(task, model, **{"accepted" if accepted else "rejected": 1})
+
+    def summary(self) -> list[dict]:
+        """每个任务、模型的调用次数、平均耗时和通过率"""
+        rows = []
+        for task, models in self.stats.items():
+            for model, record in models.items():
+                samples = record["accepted"] + record["rejected"]
+                rows.append({
+                    "task": task,
+                    "model": model,
+                    "calls": record["calls"],
+                    "errors": record["errors"],
+                    "avg_seconds": self.average_latency(task, model),
+                    "acceptance_rate": record["accepted"] / samples if samples else None,
+                })
+        return rows
+
+
+if __name__ == "__main__":
+    # 测试代码（内存统计，模拟调用）
+    policy = ModelPolicy(path=None, min_samples=3, explore_rate=0.0)
+
+    def fake_call(prompt, model, temperature):
+        if model == "gemini-2.5-flash-lite":
+            raise RuntimeError("模拟调用失败")
+        return f"[{model} @ {temperature}] {prompt}"
+
+    print(policy.call("continuation", fake_call, prompt="继续写"))
+    print(policy.call("short", fake_call, prompt="起个标题"))
+
+    # flash 续写的通过率明显低于 pro 后被排到 pro 之后
+    for _ in range(5):
+        policy.record_outcome("continuation", "gemini-2.5-flash", accepted=False)
+        policy.record_outcome("continuation", "gemini-2.5-pro", accepted=True)
+    print([o["model"] for o in policy.options("continuation")])
+    assert policy.options("continuation")[0]["model"] == "gemini-2.5-pro"
+
+    # 参考模型按 explore_rate 的概率排在首位，没有其他候选的任务不受影响
+    exploring = ModelPolicy(path=None, explore_rate=0.1, rng=random.Random(1))
+    first = [exploring.options("continuation")[0]["model"] for _ in range(1000)]
+    print(f"探索比例: {first.count('gemini-2.5-pro') / len(first):.1%}")
+    assert 50 < first.count("gemini-2.5-pro") < 150
+    assert all(exploring.options("novel_body")[0]["model"] == "gemini-2.5-pro" for _ in range(100))
+
+    for row in policy.summary():
+        print(row)
+
+    # 两个进程（实例）共用同一个统计文件，记录合并而不是互相覆盖
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = f"{tmp_dir}/model_stats.json"
+        first, second = ModelPolicy(path=path), ModelPolicy(path=path)
+        first.record_outcome("continuation", "gemini-2.5-flash", accepted=True)
+        second.record_outcome("continuation", "gemini-2.5-flash", accepted=False)
+        first.record_outcome("continuation", "gemini-2.5-flash", accepted=True)
+        record = ModelPolicy(path=path).stats["continuation"]["gemini-2.5-flash"]
+        assert (record["accepted"], record["rejected"]) == (2, 1), record
+        print("[OK] 多进程统计合并正常")
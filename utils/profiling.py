@@ -0,0 +1,440 @@
+"""
+性能分析工具（可选）
+设置 NOVEL_PROFILE=1（或 cli.py --profile）后，为每个任务采集：
+
+- 节点 prep/exec/post 和 utils 函数的调用次数、耗时和峰值内存（tracemalloc）
+- 定时采样该任务线程的调用栈，输出火焰图工具可直接读取的折叠栈（flamegraph.pl、speedscope）
+- 任务期间新增内存最多的代码行
+
+报告写入 <output_dir>/profiles/<任务名>/（report.json 和 stacks.folded）
+未开启时不替换任何函数，没有额外开销
+
+当前任务的采集器保存在 ContextVar 中，守护进程并发执行的任务各自记录；推测式生成的候选线程
+复制提交时的上下文（utils/speculative.py），计入所属任务。调用栈只采样任务自己的线程：
+运行 profile_job 的线程，以及正在执行被计时函数的候选线程
+
+tracemalloc 会明显拖慢分配密集的代码（如 MinHash 签名），NOVEL_PROFILE=cpu 只采集耗时和调用栈。
+tracemalloc 是进程全局的，无法区分并发任务的分配：同一时间只有一个任务统计内存，
+并发执行任务时（profile_job(concurrent=True)）只采集耗时和调用栈
+"""
+import contextlib
+import contextvars
+import functools
+import importlib
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+
+PROFILE_ENV = "NOVEL_PROFILE"
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+
+# 需要统计耗时的 utils 模块（模块内的公开函数和类方法）
+PROFILED_MODULES = [
+    "utils.call_gemini",
+    "utils.prompt_builder",
+    "utils.novel_parser",
+    "utils.validator",
+    "utils.dedup_index",
+    "utils.yield_stats",
+    "utils.model_policy",
+    "utils.stats_file",
+    "utils.token_budget",
+    "utils.speculative",
+]
+
+# 需要统计耗时的节点方法
+NODE_METHODS = ("prep", "exec", "post", "exec_fallback")
+
+# 当前上下文中正在采集的任务
+_active = contextvars.ContextVar("novel_profiler", default=None)
+_lock = threading.Lock()
+_installed = False
+# 正在使用 tracemalloc 统计内存的任务（同一时间只有一个）
+_memory_owner = None
+
+
+def profiling_mode() -> str | None:
+    """性能分析模式：NOVEL_PROFILE=1 为 "full"（含内存），cpu 为 "cpu"，未开启为 None"""
+    value = os.getenv(PROFILE_ENV, "0").strip().lower()
+    if value in ("1", "full"):
+        return "full"
+    if value == "cpu":
+        return "cpu"
+    return None
+
+
+def profiling_enabled() -> bool:
+    """是否开启性能分析"""
+    return profiling_mode() is not None
+
+
+def _timed(name, func):
+    """包装函数：有正在采集的任务时记录耗时和峰值内存"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active.get()
+        if profiler is None:
+            return func(*args, **kwargs)
+        frame = profiler.enter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.exit(name, frame)
+    return wrapper
+
+
+def _frame_name(code) -> str:
+    """栈帧名称：模块名:限定函数名（包的 __init__.py 使用包名）"""
+    path = Path(code.co_filename)
+    module = path.parent.name if path.stem == "__init__" else path.stem
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def install():
+    """
+    为节点方法和 utils 函数安装计时包装（每个进程只安装一次）
+
+    节点方法在类上替换（Flow 运行时会复制节点实例）；utils 函数在定义它的模块中替换，
+    并同步替换项目模块中通过 from ... import 导入的同名引用
+    """
+    global _installed
+    with _lock:
+        if _installed:
+            return
+        _installed = True
+
+    import nodes
+    from pocketflow import BaseNode
+
+    for cls in vars(nodes).values():
+        if inspect.isclass(cls) and issubclass(cls, BaseNode) and cls.__module__ == nodes.__name__:
+            for method in NODE_METHODS:
+                if method in vars(cls):
+                    setattr(cls, method, _timed(f"{cls.__name__}.{method}", vars(cls)[method]))
+
+    replaced = {}
+    for module_name in PROFILED_MODULES:
+        module = importlib.import_module(module_name)
+        short_name = module_name.rsplit(".", 1)[-1]
+        for attr, obj in list(vars(module).items()):
+            if attr.startswith("_") or getattr(obj, "__module__", None) != module_name:
+                continue
+            # 上下文管理器（如 stats_file.file_lock）包装后只计创建耗时，持锁期间计入调用它的函数
+            if inspect.isgeneratorfunction(getattr(obj, "__wrapped__", None)):
+                continue
+            if inspect.isfunction(obj):
+                replaced[obj] = _timed(f"{short_name}.{attr}", obj)
+                setattr(module, attr, replaced[obj])
+            elif inspect.isclass(obj):
+                for method_name, method in list(vars(obj).items()):
+                    if inspect.isfunction(method) and not method_name.startswith("_"):
+                        setattr(obj, method_name, _timed(f"{short_name}.{attr}.{method_name}", method))
+
+    # 替换 from utils.xxx import func 形式导入到其他项目模块中的引用
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, "__file__", None)
+        if not module_file or not Path(module_file).resolve().is_relative_to(PROJECT_DIR):
+            continue
+        for attr, obj in list(vars(module).items()):
+            if inspect.isfunction(obj) and obj in replaced:
+                setattr(module, attr, replaced[obj])
+
+
+class StackSampler(threading.Thread):
+    """定时采样指定线程的调用栈（墙钟时间采样，等待网络的线程同样计入）"""
+
+    def __init__(self, thread_ids, interval: float = 0.005):
+        """
+        Args:
+            thread_ids: 返回当前需要采样的线程 ID 集合的函数
+            interval: 采样间隔（秒）
+        """
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            sampled_ids = self.thread_ids()
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id not in sampled_ids:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    # 跳过计时包装自身的栈帧
+                    if not (code.co_name == "wrapper" and code.co_filename == __file__):
+                        stack.append(_frame_name(code))
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.counts[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def folded(self) -> str:
+        """折叠栈格式：每行为 "根;...;叶 次数" """
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+
+class JobProfiler:
+    """采集一个任务的阶段耗时、峰值内存和调用栈"""
+
+    def __init__(self, name: str, output_dir: str, shared: dict | None = None, interval: float = 0.005,
+                 trace_memory: bool = True):
+        """
+        Args:
+            name: 任务名（报告目录名）
+            output_dir: 报告根目录
+            shared: 可选，任务的 shared store，结束时将任务信息写入报告
+            interval: 调用栈采样间隔（秒）
+            trace_memory: 是否用 tracemalloc 统计峰值内存和新增分配
+        """
+        self.name = name
+        self.trace_memory = trace_memory
+        self.report_dir = Path(output_dir) / name
+        self.shared = shared
+        self.sampler = StackSampler(self.thread_ids, interval)
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._owner_id = None
+        self._threads = set()
+        self._context_token = None
+        self._started_tracing = False
+        self._start_snapshot = None
+        self.started_at = None
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def thread_ids(self) -> frozenset:
+        """当前属于该任务的线程：运行任务的线程和正在执行被计时函数的其他线程"""
+        with self._lock:
+            return frozenset(self._threads)
+
+    def enter(self) -> dict:
+        """
+        进入一个阶段
+
+        其他线程（推测式生成的候选）进入最外层阶段时加入采样，退出最外层阶段时移出，
+        线程 ID 被复用时不会误采其他任务的线程。
+
+        tracemalloc 的峰值是全局的：进入内层阶段前先把当前峰值计入外层阶段再重置，
+        退出时再把内层峰值并入外层。推测式生成等多线程场景下峰值只是近似值
+        """
+        stack = self._stack()
+        if not stack:
+            with self._lock:
+                self._threads.add(threading.get_ident())
+        frame = {"start": time.perf_counter(), "base": 0, "peak": 0}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["base"] = frame["peak"] = current
+        stack.append(frame)
+        return frame
+
+    def exit(self, name: str, frame: dict):
+        """退出阶段并记录耗时和峰值内存（相对进入时的增量）"""
+        seconds = time.perf_counter() - frame["start"]
+        stack = self._stack()
+        if stack and stack[-1] is frame:
+            stack.pop()
+        peak = 0
+        if self.trace_memory:
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        if not stack and threading.get_ident() != self._owner_id:
+            with self._lock:
+                self._threads.discard(threading.get_ident())
+
+        with self._lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_bytes": 0})
+            stage["calls"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+            stage["peak_bytes"] = max(stage["peak_bytes"], peak - frame["base"])
+
+    def start(self):
+        """在当前线程和上下文中开始采集（需在同一线程中调用 stop）"""
+        global _memory_owner
+        if self.trace_memory:
+            with _lock:
+                if _memory_owner is None:
+                    _memory_owner = self
+                else:
+                    print(f"⚠️  任务 {_memory_owner.name} 正在统计内存，{self.name} 只采集耗时和调用栈")
+                    self.trace_memory = False
+
+        self._owner_id = threading.get_ident()
+        self._threads.add(self._owner_id)
+        self._context_token = _active.set(self)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            self._start_snapshot = tracemalloc.take_snapshot()
+        self.started_at = time.time()
+        self.sampler.start()
+
+    def stop(self) -> Path:
+        """停止采集并写入报告，返回报告目录"""
+        global _memory_owner
+        _active.reset(self._context_token)
+        self.sampler.stop()
+        wall_seconds = time.time() - self.started_at
+
+        top_allocations, traced_peak = [], None
+        if self.trace_memory:
+            # 任务期间新增内存最多的代码行（排除 tracemalloc 自身）
+            snapshot_filter = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            end_snapshot = tracemalloc.take_snapshot().filter_traces(snapshot_filter)
+            growth = end_snapshot.compare_to(self._start_snapshot.filter_traces(snapshot_filter), "lineno")
+            top_allocations = [
+                {"where": str(stat.traceback[0]), "size_diff_bytes": stat.size_diff, "count_diff": stat.count_diff}
+                for stat in growth[:15]
+            ]
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            if self._started_tracing:
+                tracemalloc.stop()
+            with _lock:
+                _memory_owner = None
+
+        stages = [{"stage": name, **values} for name, values in self.stages.items()]
+        stages.sort(key=lambda stage: stage["seconds"], reverse=True)
+        report = {
+            "name": self.name,
+            "started_at": self.started_at,
+            "wall_seconds": wall_seconds,
+            "trace_memory": self.trace_memory,
+            "sample_interval": self.sampler.interval,
+            "samples": self.sampler.samples,
+            "traced_peak_bytes": traced_peak,
+            "stages": stages,
+            "top_allocations": top_allocations,
+        }
+        if self.shared is not None:
+            report["job"] = self.shared.get("job")
+            report["title"] = (self.shared.get("novel") or {}).get("title")
+
+        self.report_dir.mkdir(parents=True, exist_ok=True)
+        (self.report_dir / "report.json").write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        (self.report_dir / "stacks.folded").write_text(self.sampler.folded(), encoding="utf-8")
+
+        print(f"\n性能报告: {self.report_dir}（总耗时 {wall_seconds:.2f}s）")
+        for stage in stages[:5]:
+            memory = f"，峰值内存 +{stage['peak_bytes'] / 1024:.0f} KiB" if self.trace_memory else ""
+            print(f"  - {stage['stage']}: {stage['seconds']:.3f}s / {stage['calls']} 次{memory}")
+        return self.report_dir
+
+
+@contextlib.contextmanager
+def profile_job(shared: dict | None = None, name: str | None = None, concurrent: bool = False):
+    """
+    为一个任务采集性能数据；未开启性能分析时不做任何事
+
+    Args:
+        shared: 可选，任务的 shared store（报告写入 shared["output_dir"]/profiles，并记录任务信息）
+        name: 报告目录名，默认按时间生成
+        concurrent: 是否与其他任务并发执行（如多个工作线程的守护进程），为 True 时不统计内存
+
+    Yields:
+        JobProfiler，未开启性能分析时为 None
+    """
+    mode = profiling_mode()
+    if mode is None:
+        yield None
+        return
+
+    install()
+    output_dir = Path((shared or {}).get("output_dir", "output")) / "profiles"
+    name = name or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    if mode == "full" and concurrent:
+        print(f"⚠️  并发执行的任务无法区分 tracemalloc 统计，{name} 只采集耗时和调用栈")
+    profiler = JobProfiler(name, output_dir, shared, trace_memory=mode == "full" and not concurrent)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+
+
+if __name__ == "__main__":
+    # 测试代码：对内容验证和清理做一次性能分析（不调用 API）
+    import tempfile
+
+    from utils import validator
+
+    os.environ[PROFILE_ENV] = "1"
+    content = ("这是正文内容，包含一些 English words 和标点。" * 12 + "\n") * 150
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with profile_job({"output_dir": tmp_dir}, name="self-test") as profiler:
+            for _ in range(3):
+                validator.validate_content(content)
+                validator.clean_content(content)
+
+        report = json.loads((profiler.report_dir / "report.json").read_text(encoding="utf-8"))
+        stage_names = {stage["stage"] for stage in report["stages"]}
+        print(f"阶段: {sorted(stage_names)}")
+        print(f"采样次数: {report['samples']}")
+        assert "validator.has_long_english_sequence" in stage_names
+        assert (profiler.report_dir / "stacks.folded").read_text(encoding="utf-8")
+        print("[OK] 性能报告已生成")
+
+        # 两个任务在不同线程中并发采集：各自只记录自己的阶段和线程，
+        # 推测式生成的候选线程计入提交它们的任务
+        from utils.speculative import first_valid
+
+        def job_a():
+            with profile_job({"output_dir": tmp_dir}, name="job-a", concurrent=True):
+                first_valid(lambda index, cancel_event: validator.validate_content(content),
+                            lambda result: [], k=2)
+                for _ in range(20):
+                    validator.has_long_english_sequence(content)
+
+        def job_b():
+            with profile_job({"output_dir": tmp_dir}, name="job-b", concurrent=True):
+                for _ in range(20):
+                    validator.clean_content(content)
+
+        threads = [threading.Thread(target=job_a, name="thread-a"), threading.Thread(target=job_b, name="thread-b")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        reports = {}
+        for job in ("job-a", "job-b"):
+            job_dir = Path(tmp_dir) / "profiles" / job
+            report = json.loads((job_dir / "report.json").read_text(encoding="utf-8"))
+            stacks = (job_dir / "stacks.folded").read_text(encoding="utf-8")
+            reports[job] = ({stage["stage"] for stage in report["stages"]}, {line.split(";")[0] for line in stacks.splitlines()})
+            print(f"{job}: 阶段 {sorted(reports[job][0])}，线程 {sorted(reports[job][1])}")
+        assert "validator.validate_content" in reports["job-a"][0]
+        assert "validator.clean_content" not in reports["job-a"][0]
+        assert reports["job-b"][0] == {"validator.clean_content"}
+        assert "thread-b" not in reports["job-a"][1] and reports["job-b"][1] == {"thread-b"}
+        print("[OK] 并发任务的性能数据互不干扰")
@@ -19,12 +19,29 @@ def build_random_prompt(tags: list, commands: list, events: list) -> str:
     Returns:
         格式化的提示词字符串
     """
-    # 随机选择一个命令模板
+    # 随机选择一个命令模板和一个事件
     command = random.choice(commands)
-
-    # 随机选择一个事件
     event = random.choice(events)
 
+    return build_prompt(command, event, tags)
+
+
+def build_prompt(command: str, event: str, tags: list, total_chars: int = 18000,
+                 chapter_chars: int = 1700, chapters: int = 11) -> str:
+    """
+    使用指定的命令模板和事件构建提示词
+
+    Args:
+        command: 命令模板文本（包含 {{event}} 占位符）
+        event: 事件描述
+        tags: 标签列表 [{"label": "主题", "name": "科幻末世"}, ...]
+        total_chars: 要求的总字数
+        chapter_chars: 每章字数
+        chapters: 章节数
+
+    Returns:
+        格式化的提示词字符串
+    """
     # 替换事件占位符
     command = command.replace('{{event}}', event)
 
@@ -44,7 +61,7 @@ def build_random_prompt(tags: list, commands: list, events: list) -> str:
 
     # 构建最终提示词
     prompt = f"""{command}
-需要总字数18000字，每章约1700字，共计11章
+需要总字数{total_chars}字，每章约{chapter_chars}字，共计{chapters}章
 
 ---
 请从以下标签列表中，为你的小说选择合适的标签。规则如下：
@@ -88,6 +105,47 @@ CONTENT{{
     return prompt
 
 
+def build_part_prompt(prompt: str, previous_output: str, start_chapter: int, end_chapter: int,
+                      is_last: bool) -> str:
+    """
+    构建分段生成中某一段的提示词
+
+    第一段输出 TITLE、TAG、INTRO 和前几章正文；后续段落在前文基础上继续输出正文，
+    只有最后一段输出 "--END--" 并闭合 CONTENT
+
+    Args:
+        prompt: 完整小说的提示词
+        previous_output: 之前各段已输出的内容（第一段为空）
+        start_chapter: 本段起始章节号
+        end_chapter: 本段结束章节号
+        is_last: 是否为最后一段
+
+    Returns:
+        本段的提示词
+    """
+    if is_last:
+        ending = '写完后输出一行"--END--"，再输出"}CONTENT"闭合正文'
+    else:
+        ending = '本段写完后直接停止，不要输出"--END--"，也不要闭合 CONTENT'
+
+    if not previous_output:
+        return f"""{prompt}
+---
+注意：由于篇幅较长，本次只输出 TITLE、TAG、INTRO 和正文的第{start_chapter}章到第{end_chapter}章，{ending}。
+"""
+
+    return f"""{prompt}
+---
+以下是你已经输出的内容：
+
+{previous_output}
+
+---
+请紧接上文继续输出正文的第{start_chapter}章到第{end_chapter}章，不要重复已输出的内容，
+不要再输出 TITLE、TAG、INTRO 和 CONTENT{{ 标记，章节标题格式保持为"## 第[数字]章 [章节标题]"，{ending}。
+"""
+
+
 if __name__ == "__main__":
     # 测试代码
     test_tags = [
@@ -0,0 +1,138 @@
+"""
+推测式多候选生成工具
+同一提示词并行生成 k 个候选，逐个检查完成的候选，第一个通过检查的胜出并取消其余候选
+"""
+import contextvars
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+
+def choose_k(failure_rate: float, target_success: float = 0.9, max_k: int = 4) -> int:
+    """
+    根据观测到的单次生成失败率选择并行候选数
+
+    取满足 1 - failure_rate^k >= target_success 的最小 k，即至少一个候选通过的概率达到目标
+
+    Args:
+        failure_rate: 单次生成失败率 (0.0-1.0)
+        target_success: 一轮内至少一个候选通过的目标概率
+        max_k: 候选数上限（控制额外 token 消耗）
+
+    Returns:
+        候选数 k (1 <= k <= max_k)
+    """
+    if failure_rate <= 0:
+        return 1
+    if failure_rate >= 1:
+        return max_k
+    k = math.ceil(math.log(1 - target_success) / math.log(failure_rate))
+    return max(1, min(k, max_k))
+
+
+def first_valid(generate, check, k: int, drain_timeout: float = 10.0) -> dict:
+    """
+    并行生成 k 个候选，返回第一个通过检查的候选
+
+    Args:
+        generate: 生成函数 generate(index, cancel_event) -> result，
+                  应定期检查 cancel_event 并在被设置后尽快退出（抛出异常即可）
+        check: 检查函数 check(result) -> list[str]，返回错误列表，空列表表示通过
+        k: 候选数
+        drain_timeout: 胜出后等待被取消的候选退出的最长秒数，
+                       退出后候选才会写入自己的 token 用量
+
+    Returns:
+        {
+            "result": 胜出候选（都未通过时为最后完成的候选），
+            "winner": 胜出候选的序号（都未通过时为 None），
+            "rejected": [(序号, 候选, 错误列表), ...] 已完成但未通过检查的候选,
+            "cancelled": 被取消的候选数,
+            "pending": 等待超时后仍未退出的候选数（其 token 用量未能计入）
+        }
+
+    Raises:
+        Exception: 所有候选都在生成阶段抛出异常时，重新抛出最后一个异常
+    """
+    cancel_event = threading.Event()
+    rejected = []
+    last_error = None
+    winner = None
+    result = None
+
+    executor = ThreadPoolExecutor(max_workers=k, thread_name_prefix="speculative")
+    # 每个候选在提交时上下文的副本中运行（如性能分析的当前任务），同一个 Context 不能被多个线程同时进入
+    futures = {
+        executor.submit(contextvars.copy_context().run, generate, i, cancel_event): i
+        for i in range(k)
+    }
+    try:
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                candidate = future.result()
+            except Exception as e:
+                if not cancel_event.is_set():
+                    last_error = e
+                continue
+
+            errors = check(candidate)
+            if not errors:
+                winner, result = index, candidate
+                cancel_event.set()
+                break
+            rejected.append((index, candidate, errors))
+    finally:
+        # 取消尚未开始的候选；正在流式生成的候选会在下一个 chunk 检查 cancel_event 后退出
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # 等待正在生成的候选退出，调用方据此汇总所有候选的 token 用量
+    _, not_done = wait(futures, timeout=drain_timeout)
+
+    if winner is None:
+        if not rejected:
+            raise last_error
+        result = rejected[-1][1]
+
+    completed = len(rejected) + (1 if winner is not None else 0)
+    return {
+        "result": result,
+        "winner": winner,
+        "rejected": rejected,
+        "cancelled": k - completed,
+        "pending": len(not_done)
+    }
+
+
+if __name__ == "__main__":
+    # 测试代码
+    import random
+    import time
+
+    for rate in [0.0, 0.2, 0.4, 0.6, 0.9]:
+        print(f"失败率 {rate:.1f} -> k = {choose_k(rate)}")
+
+    usages = {}
+
+    def fake_generate(index, cancel_event):
+        # 模拟流式生成：每 10ms 检查一次取消信号，退出时（包括被取消）写入 token 用量
+        for chunk in range(random.randint(5, 30)):
+            if cancel_event.is_set():
+                usages[index] = chunk
+                raise RuntimeError(f"候选 {index} 已取消")
+            time.sleep(0.01)
+        usages[index] = chunk + 1
+        return f"候选{index}" + ("" if index % 2 else "（不合格）")
+
+    def fake_check(candidate):
+        return ["不合格"] if "不合格" in candidate else []
+
+    start = time.time()
+    outcome = first_valid(fake_generate, fake_check, k=4)
+    print(f"胜出: {outcome['winner']} -> {outcome['result']}，"
+          f"未通过: {len(outcome['rejected'])}，已取消: {outcome['cancelled']}，"
+          f"未退出: {outcome['pending']}，耗时 {time.time() - start:.2f}s")
+    # 正在生成的候选都已退出并写入用量（尚未开始的候选被直接取消，没有用量）
+    assert outcome["pending"] == 0 and len(usages) == 4
+    print(f"各候选用量: {usages}")
@@ -0,0 +1,77 @@
+"""
+统计文件工具
+多个进程共用同一个 JSON 统计文件时，每次记录都在文件锁内重新读取文件、
+累加本次的增量再写回，进程之间不会互相覆盖计数
+"""
+import contextlib
+import json
+import os
+import time
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextlib.contextmanager
+def file_lock(path: Path):
+    """对 path 对应的 .lock 文件加排他锁（跨进程）"""
+    lock_path = Path(f"{path}.lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a+b") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def add_counts(target: dict, delta: dict):
+    """将 delta 中的数值逐项累加到 target（嵌套字典递归累加，target 中没有的字段直接复制）"""
+    for key, value in delta.items():
+        if isinstance(value, dict):
+            add_counts(target.setdefault(key, {}), value)
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+def read_section(path: Path, section: str) -> dict:
+    """读取统计文件中的一个分区（文件不存在时返回空字典）"""
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8")).get(section, {})
+
+
+def merge_counts(path: Path, section: str, delta: dict) -> dict:
+    """
+    在文件锁内把增量合并进统计文件并写回
+
+    Args:
+        path: 统计文件路径
+        section: 文件中的分区名（如 "combos"）
+        delta: 要累加的增量
+
+    Returns:
+        合并后的分区内容（包含其他进程记录的数据）
+    """
+    path = Path(path)
+    with file_lock(path):
+        data = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {}
+        add_counts(data.setdefault(section, {}), delta)
+        data["updated_at"] = time.time()
+        # 先写临时文件再替换，避免中途中断写坏文件
+        tmp_file = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp_file.replace(path)
+    return data[section]
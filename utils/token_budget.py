@@ -0,0 +1,221 @@
+"""
+Token 预算工具
+在调用 API 之前估算提示词和输出的 token 数，确定输出上限，
+预算不足时减少章节数或改为分段生成，避免必然被截断的生成
+"""
+import hashlib
+import json
+import math
+
+from utils.prompt_builder import build_prompt
+
+
+# 各模型的输出 token 上限（含思考 token）、上下文窗口和思考预算
+# 思考 token 计入输出上限，规划时按思考预算预留输出额度，并通过 thinking_config 限制模型不超出预算；
+# thinking 为 None 的模型不支持设置思考预算
+MODEL_LIMITS = {
+    "gemini-2.5-pro": {"output": 65536, "context": 1048576, "thinking": 8192},
+    "gemini-2.5-flash": {"output": 65536, "context": 1048576, "thinking": 4096},
+    "gemini-2.5-flash-lite": {"output": 65536, "context": 1048576, "thinking": 0},
+    "gemini-2.0-flash": {"output": 8192, "context": 1048576, "thinking": None},
+}
+DEFAULT_LIMITS = {"output": 8192, "context": 1048576, "thinking": None}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    离线估算文本的 token 数（无法调用 count_tokens 时使用）
+
+    中文等非 ASCII 字符按每字 1 个 token 计，ASCII 字符按每 4 个 1 个 token 计
+
+    Args:
+        text: 待估算文本
+
+    Returns:
+        估算的 token 数
+    """
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return (len(text) - ascii_chars) + math.ceil(ascii_chars / 4)
+
+
+class TokenBudget:
+    """按模型限制规划单次生成的章节数、输出上限和生成方式"""
+
+    def __init__(self, model: str = "gemini-2.5-pro", count_fn=None, tokens_per_char: float = 1.0,
+                 headroom: float = 1.25, thinking_reserve: int | None = None, markup_tokens: int = 1500):
+        """
+        Args:
+            model: 模型名称
+            count_fn: token 计数函数 count_fn(text, model) -> int，默认调用 Gemini count_tokens，
+                      失败时退回 estimate_tokens
+            tokens_per_char: 正文每字估算的 token 数
+            headroom: 正文 token 估算的放大系数（模型往往超出要求字数）
+            thinking_reserve: 思考预算（为思考 token 预留的输出额度），默认按模型取 MODEL_LIMITS 中的值；
+                              模型不支持设置思考预算时忽略
+            markup_tokens: 标题、标签、简介和格式标记预留的 token
+        """
+        self.model = model
+        self.count_fn = count_fn
+        self.tokens_per_char = tokens_per_char
+        self.headroom = headroom
+        self.markup_tokens = markup_tokens
+        self.limits = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+        # 随生成计划传给 call_gemini 的思考预算，None 表示不设置
+        self.thinking_budget = None
+        if self.limits["thinking"] is not None:
+            self.thinking_budget = self.limits["thinking"] if thinking_reserve is None else thinking_reserve
+        self.thinking_reserve = self.thinking_budget or 0
+        self._template_cache = {}
+
+    def _count(self, text: str) -> tuple[int, bool]:
+        """
+        统计文本的 token 数
+
+        Returns:
+            (token 数, 是否为计数函数的结果)；count_tokens 调用失败时退回离线估算，第二项为 False
+        """
+        if self.count_fn is not None:
+            return self.count_fn(text, self.model), True
+        try:
+            from utils.call_gemini import count_tokens
+            return count_tokens(text, self.model), True
+        except Exception as e:
+            print(f"⚠️  count_tokens 调用失败，使用离线估算: {e}")
+            return estimate_tokens(text), False
+
+    def prompt_tokens(self, command: str, event: str, tags: list) -> int:
+        """
+        统计提示词的输入 token 数
+
+        模板和标签部分按模板缓存，只在第一次计数成功时写入缓存（离线估算的结果不缓存，
+        下次调用会重新尝试 count_tokens）；事件部分离线估算
+
+        Args:
+            command: 命令模板文本
+            event: 事件描述
+            tags: 标签列表
+
+        Returns:
+            输入 token 数
+        """
+        key = hashlib.sha1(
+            (command + json.dumps(tags, ensure_ascii=False, sort_keys=True)).encode("utf-8")
+        ).hexdigest()
+        template_tokens = self._template_cache.get(key)
+        if template_tokens is None:
+            template_tokens, exact = self._count(build_prompt(command, "", tags))
+            if exact:
+                self._template_cache[key] = template_tokens
+        event_tokens = estimate_tokens(event) * command.count("{{event}}")
+        return template_tokens + event_tokens
+
+    def output_tokens(self, total_chars: int) -> int:
+        """估算输出 total_chars 字正文所需的输出 token（含思考和格式预留）"""
+        body_tokens = math.ceil(total_chars * self.tokens_per_char * self.headroom)
+        return body_tokens + self.markup_tokens + self.thinking_reserve
+
+    def plan(self, prompt_tokens: int, total_chars: int = 18000, chapter_chars: int = 1700,
+             chapters: int = 11, min_chars: int = 8000) -> dict:
+        """
+        规划一次小说生成
+
+        Args:
+            prompt_tokens: 提示词 token 数
+            total_chars: 要求的总字数
+            chapter_chars: 每章字数
+            chapters: 章节数
+            min_chars: 最少字数（与验证规则一致），减少章节时不低于该值
+
+        Returns:
+            {
+                "mode": "single" | "reduced" | "split",
+                "total_chars", "chapter_chars", "chapters",
+                "prompt_tokens", "max_output_tokens",
+                "thinking_budget": 思考预算（与 max_output_tokens 一起传给 call_gemini，None 表示不设置）,
+                "parts": [(起始章节, 结束章节), ...]  # 仅 split 模式
+            }
+        """
+        output_limit = self.limits["output"]
+        context_limit = self.limits["context"]
+
+        def fits(chars):
+            needed = self.output_tokens(chars)
+            return needed <= output_limit and prompt_tokens + needed <= context_limit
+
+        plan = {
+            "mode": "single",
+            "total_chars": total_chars,
+            "chapter_chars": chapter_chars,
+            "chapters": chapters,
+            "prompt_tokens": prompt_tokens,
+            "thinking_budget": self.thinking_budget,
+            "parts": [],
+        }
+
+        if fits(total_chars):
+            plan["max_output_tokens"] = min(output_limit, self.output_tokens(total_chars))
+            return plan
+
+        # 1. 减少章节数，总字数仍满足最少字数要求
+        for reduced in range(chapters - 1, 0, -1):
+            reduced_chars = reduced * chapter_chars
+            if reduced_chars < min_chars:
+                break
+            if fits(reduced_chars):
+                plan.update({
+                    "mode": "reduced",
+                    "total_chars": reduced_chars,
+                    "chapters": reduced,
+                    "max_output_tokens": min(output_limit, self.output_tokens(reduced_chars)),
+                })
+                return plan
+
+        # 2. 改为分段生成：每段的输入包含之前各段的输出
+        per_part = chapters
+        while per_part > 1 and not fits(per_part * chapter_chars):
+            per_part -= 1
+        if not fits(per_part * chapter_chars):
+            raise ValueError(f"模型 {self.model} 的输出上限 {output_limit} token 不足以生成单章内容")
+
+        parts = []
+        for start in range(1, chapters + 1, per_part):
+            parts.append((start, min(start + per_part - 1, chapters)))
+
+        # 最后一段的输入最长：提示词 + 之前所有段的输出
+        previous_tokens = math.ceil((chapters - (parts[-1][1] - parts[-1][0] + 1))
+                                    * chapter_chars * self.tokens_per_char * self.headroom)
+        if prompt_tokens + previous_tokens + self.output_tokens(per_part * chapter_chars) > context_limit:
+            raise ValueError(f"提示词和已生成内容超出模型 {self.model} 的上下文窗口")
+
+        plan.update({
+            "mode": "split",
+            "max_output_tokens": min(output_limit, self.output_tokens(per_part * chapter_chars)),
+            "parts": parts,
+        })
+        return plan
+
+
+if __name__ == "__main__":
+    # 测试代码（离线估算，不调用 API）
+    test_command = "写一个关于{{event}}的故事，要有创意和想象力。"
+    test_tags = [{"label": "主题", "name": "科幻末世"}, {"label": "情节", "name": "穿越"}]
+
+    for model in ["gemini-2.5-pro", "gemini-2.0-flash"]:
+        budget = TokenBudget(model=model, count_fn=lambda text, _: estimate_tokens(text))
+        tokens = budget.prompt_tokens(test_command, "末日求生", test_tags)
+        print(f"{model}: 提示词 {tokens} token")
+        print(f"  默认要求: {budget.plan(tokens)}")
+        print(f"  60000 字: {budget.plan(tokens, total_chars=60000, chapters=35)}")
+
+    # 输出上限按思考预算预留额度，思考预算随计划传给 call_gemini；不支持思考预算的模型不设置
+    assert TokenBudget("gemini-2.5-pro").plan(500)["thinking_budget"] == 8192
+    assert TokenBudget("gemini-2.0-flash").plan(500)["thinking_budget"] is None
+
+    # count_tokens 失败时的离线估算不缓存，恢复后使用准确计数
+    budget = TokenBudget()
+    results = [(300, False), (1000, True)]
+    budget._count = lambda text: results.pop(0)
+    assert budget.prompt_tokens(test_command, "", test_tags) == 300
+    assert budget.prompt_tokens(test_command, "", test_tags) == 1000
+    assert budget.prompt_tokens(test_command, "", test_tags) == 1000  # 命中缓存，不再计数
+    print("[OK] 离线估算结果未写入缓存")
@@ -0,0 +1,294 @@
+"""
+多机任务队列工具
+基于 SQLite 的共享任务队列，支持租约和心跳：
+工作进程领取任务时获得一段时间的租约，处理期间定期续约；
+进程崩溃后租约过期，任务会被其他工作进程重新领取
+
+默认使用 WAL 模式，只适用于同一台机器上的多个进程：WAL 依赖共享内存索引，
+数据库放在 NFS/SMB 等网络目录中由多台机器同时访问会损坏。
+多台机器共享时使用 journal_mode="DELETE"（回滚日志，只依赖文件锁），
+并且网络文件系统必须正确实现 POSIX 字节范围锁；锁不可靠的文件系统上不能共享 SQLite 队列
+"""
+import itertools
+import json
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+
+DEFAULT_QUEUE_FILE = "output/queue/jobs.db"
+
+
+class LeaseLost(RuntimeError):
+    """任务的租约已丢失（过期后被其他进程领取），当前进程应停止处理该任务"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    template      TEXT NOT NULL,
+    event         TEXT NOT NULL,
+    status        TEXT NOT NULL DEFAULT 'pending',   -- pending / leased / done / failed
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    max_attempts  INTEGER NOT NULL DEFAULT 3,
+    lease_owner   TEXT,
+    lease_expires REAL,
+    checkpoint    TEXT,
+    result        TEXT,
+    error         TEXT,
+    created_at    REAL NOT NULL,
+    updated_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, lease_expires);
+"""
+
+
+class WorkQueue:
+    """SQLite 任务队列，每个进程（线程）使用自己的 WorkQueue 实例"""
+
+    def __init__(self, path: str = DEFAULT_QUEUE_FILE, lease_seconds: float = 900,
+                 journal_mode: str = "WAL"):
+        """
+        Args:
+            path: 数据库文件路径
+            lease_seconds: 租约时长，工作进程需在此时间内续约
+            journal_mode: "WAL"（单机多进程）或 "DELETE"（多台机器共享网络目录），
+                          同一队列的所有进程必须使用相同的模式
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.journal_mode = journal_mode.upper()
+        # isolation_level=None：手动控制事务，领取任务时使用 BEGIN IMMEDIATE 加写锁
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA busy_timeout=30000")
+        # 其他进程仍以另一种模式打开数据库时无法切换（返回原模式或数据库被锁），此时拒绝使用
+        try:
+            mode = self.conn.execute(f"PRAGMA journal_mode={self.journal_mode}").fetchone()[0]
+        except sqlite3.OperationalError as e:
+            mode = f"未知: {e}"
+        if mode.upper() != self.journal_mode:
+            self.conn.close()
+            raise RuntimeError(f"无法将 {self.path} 切换为 {self.journal_mode} 模式（当前为 {mode}），"
+                               f"请先停止以其他模式运行的工作进程")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def plan_jobs(self, templates: list, events: list, count: int, max_attempts: int = 3,
+                  weights: list | None = None) -> int:
+        """
+        规划 count 个 (模板, 事件) 任务
+
+        未指定权重时按组合轮流分配，保证覆盖所有组合；指定权重时按权重抽样（自适应采样）
+
+        Args:
+            templates: 模板名称列表
+            events: 事件列表
+            count: 任务数
+            max_attempts: 每个任务最多被领取的次数
+            weights: 可选，每个组合的权重，顺序与 itertools.product(templates, events) 一致
+                     （即 YieldStats.combo_weights 的顺序）
+
+        Returns:
+            新增的任务数
+        """
+        combos = list(itertools.product(templates, events))
+        if weights is not None:
+            if len(weights) != len(combos):
+                raise ValueError(f"权重数 {len(weights)} 与组合数 {len(combos)} 不一致")
+            planned = random.choices(combos, weights=weights, k=count)
+        else:
+            random.shuffle(combos)
+            planned = itertools.islice(itertools.cycle(combos), count)
+        now = time.time()
+        rows = [(template, event, max_attempts, now, now) for template, event in planned]
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT INTO jobs (template, event, max_attempts, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        return len(rows)
+
+    def claim(self, worker_id: str, batch: int = 1) -> list[dict]:
+        """
+        领取最多 batch 个任务：待处理的任务，或租约已过期的任务
+
+        Args:
+            worker_id: 工作进程 ID
+            batch: 最多领取的任务数
+
+        Returns:
+            [{"id", "template", "event", "attempts", "checkpoint"}, ...]
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            rows = self.conn.execute(
+                """
+                SELECT id, template, event, attempts, checkpoint FROM jobs
+                WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?))
+                  AND attempts < max_attempts
+                ORDER BY id LIMIT ?
+                """,
+                (now, batch)
+            ).fetchall()
+            for row in rows:
+                self.conn.execute(
+                    """
+                    UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?,
+                                    attempts = attempts + 1, updated_at = ?
+                    WHERE id = ?
+                    """,
+                    (worker_id, now + self.lease_seconds, now, row["id"])
+                )
+            # 租约过期且已达到最大领取次数的任务标记为失败
+            self.conn.execute(
+                """
+                UPDATE jobs SET status = 'failed', error = '租约过期次数达到上限', updated_at = ?
+                WHERE status = 'leased' AND lease_expires < ? AND attempts >= max_attempts
+                """,
+                (now, now)
+            )
+
+        return [
+            {
+                "id": row["id"],
+                "template": row["template"],
+                "event": row["event"],
+                "attempts": row["attempts"] + 1,
+                "checkpoint": json.loads(row["checkpoint"]) if row["checkpoint"] else None,
+            }
+            for row in rows
+        ]
+
+    def _update_leased(self, job_id: int, worker_id: str, sql: str, params: tuple) -> bool:
+        """只在租约仍属于该工作进程时更新任务，返回是否更新成功"""
+        with self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE jobs SET {sql}, updated_at = ? WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                (*params, time.time(), job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def heartbeat(self, job_id: int, worker_id: str) -> bool:
+        """
+        续约
+
+        Returns:
+            False 表示租约已丢失（已过期并被其他进程领取），应停止处理该任务
+        """
+        return self._update_leased(job_id, worker_id, "lease_expires = ?",
+                                   (time.time() + self.lease_seconds,))
+
+    def checkpoint(self, job_id: int, worker_id: str, state: dict) -> bool:
+        """保存任务的中间状态并续约，重新领取该任务的进程可以从检查点继续"""
+        return self._update_leased(job_id, worker_id, "checkpoint = ?, lease_expires = ?",
+                                   (json.dumps(state, ensure_ascii=False), time.time() + self.lease_seconds))
+
+    def complete(self, job_id: int, worker_id: str, result: dict) -> bool:
+        """报告任务完成"""
+        return self._update_leased(job_id, worker_id, "status = 'done', result = ?, lease_owner = NULL",
+                                   (json.dumps(result, ensure_ascii=False),))
+
+    def fail(self, job_id: int, worker_id: str, error: str) -> bool:
+        """报告任务失败：未达到最大领取次数时放回队列，否则标记为失败"""
+        return self._update_leased(
+            job_id, worker_id,
+            "status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, "
+            "error = ?, lease_owner = NULL, lease_expires = NULL",
+            (error,)
+        )
+
+    def counts(self) -> dict:
+        """各状态的任务数（租约过期的任务单独计为 expired）"""
+        rows = self.conn.execute(
+            """
+            SELECT CASE WHEN status = 'leased' AND lease_expires < ? THEN 'expired' ELSE status END AS state,
+                   COUNT(*) AS n
+            FROM jobs GROUP BY state
+            """,
+            (time.time(),)
+        ).fetchall()
+        return {row["state"]: row["n"] for row in rows}
+
+    def results(self) -> list[dict]:
+        """已完成任务的结果"""
+        rows = self.conn.execute(
+            "SELECT id, template, event, attempts, result FROM jobs WHERE status = 'done' ORDER BY id"
+        ).fetchall()
+        return [{**dict(row), "result": json.loads(row["result"])} for row in rows]
+
+
+def _self_test_worker(path, worker_id, lease_seconds, crash, journal_mode):
+    """测试用工作进程：crash=True 时领取一个任务后直接退出，模拟进程崩溃"""
+    queue = WorkQueue(path, lease_seconds=lease_seconds, journal_mode=journal_mode)
+    while True:
+        jobs = queue.claim(worker_id, batch=2)
+        if not jobs:
+            counts = queue.counts()
+            if counts.get("leased", 0) == 0 and counts.get("expired", 0) == 0 and counts.get("pending", 0) == 0:
+                return
+            time.sleep(0.1)
+            continue
+        for job in jobs:
+            if crash:
+                import os
+                os._exit(1)
+            time.sleep(random.uniform(0.01, 0.05))
+            queue.checkpoint(job["id"], worker_id, {"stage": "generated"})
+            queue.complete(job["id"], worker_id, {"worker": worker_id})
+
+
+if __name__ == "__main__":
+    # 测试代码：多个工作进程同时领取任务，其中一个进程领取后崩溃，
+    # 其租约过期后任务被其他进程重新领取，所有任务恰好完成一次（两种日志模式各测一次）
+    import multiprocessing
+    import tempfile
+
+    for journal_mode in ["WAL", "DELETE"]:
+        print(f"== journal_mode={journal_mode}")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = str(Path(tmp_dir) / "jobs.db")
+            lease = 1.0
+
+            queue = WorkQueue(db_path, lease_seconds=lease, journal_mode=journal_mode)
+            planned = queue.plan_jobs(["template1_v2.txt", "template1_upgraded.txt"],
+                                      ["末日求生", "时空穿越", "重生复仇"], 30)
+            print(f"规划任务: {planned}")
+
+            crashed = multiprocessing.Process(target=_self_test_worker,
+                                              args=(db_path, "crash", lease, True, journal_mode))
+            crashed.start()
+            crashed.join()
+            print(f"崩溃进程退出码: {crashed.exitcode}，队列状态: {queue.counts()}")
+
+            workers = [
+                multiprocessing.Process(target=_self_test_worker,
+                                        args=(db_path, f"worker-{i}", lease, False, journal_mode))
+                for i in range(4)
+            ]
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            results = queue.results()
+            by_worker = {}
+            for row in results:
+                by_worker[row["result"]["worker"]] = by_worker.get(row["result"]["worker"], 0) + 1
+            reclaimed = [row["id"] for row in results if row["attempts"] > 1]
+
+            print(f"队列状态: {queue.counts()}，耗时 {time.time() - start:.2f}s")
+            print(f"各进程完成数: {by_worker}")
+            print(f"崩溃后重新领取的任务: {reclaimed}")
+            assert len(results) == planned, "存在未完成的任务"
+            assert len({row["id"] for row in results}) == planned, "存在重复完成的任务"
+            assert reclaimed, "崩溃进程的任务没有被重新领取"
+            print("[OK] 所有任务恰好完成一次")
+
+            queue.close()
@@ -0,0 +1,290 @@
+"""
+模板/事件产出统计工具
+按 (命令模板, 事件) 组合记录每次生成的重试、验证失败、token 消耗与通过耗时，
+持久化到 JSON 文件（读写方式见 utils/stats_file.py），并可据此计算自适应采样权重
+"""
+import functools
+import random
+import threading
+from pathlib import Path
+
+from utils.stats_file import add_counts, merge_counts, read_section
+
+
+DEFAULT_STATS_FILE = "output/stats/yield_stats.json"
+
+# 验证错误信息 -> 失败类别（与 validator.validate_content 的错误文案对应）
+VALIDATION_FAILURE_KINDS = [
+    ("少于8000字", "too_short"),
+    ("英文字母序列", "long_english"),
+    ("超长", "long_line"),
+    ("疑似重复", "near_duplicate"),
+]
+
+
+def classify_validation_error(error: str) -> str:
+    """
+    将验证错误信息归类
+
+    Args:
+        error: validate_content 返回的单条错误信息
+
+    Returns:
+        失败类别：too_short / long_english / long_line / near_duplicate / other
+    """
+    for keyword, kind in VALIDATION_FAILURE_KINDS:
+        if keyword in error:
+            return kind
+    return "other"
+
+
+def _locked(method):
+    """在实例锁内执行方法"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _empty_record() -> dict:
+    return {
+        "attempts": 0,            # 调用生成的次数
+        "jobs": 0,                # 进入该组合的任务数
+        "accepted": 0,            # 通过验证并保存的小说数
+        "first_pass": 0,          # 第一轮生成即通过的小说数
+        "parse_failures": 0,
+        "validation_failures": {},
+        "tokens": 0,              # 该组合累计消耗的 token
+        "generation_seconds": 0.0,
+        "accept_seconds": 0.0,    # 通过小说的累计耗时（从任务开始计算）
+        "tags": {},               # 通过小说选择的标签计数
+        "generated_tags": {},     # 每次解析成功的生成选择的标签计数（含未通过验证的）
+    }
+
+
+class YieldStats:
+    """按 (模板, 事件) 组合聚合的产出统计"""
+
+    def __init__(self, path: str = DEFAULT_STATS_FILE):
+        self.path = Path(path)
+        self.combos = {}
+        # 守护进程中多个任务并发记录
+        self._lock = threading.RLock()
+        self.load()
+
+    @staticmethod
+    def key(template: str, event: str) -> str:
+        return f"{template}|{event}"
+
+    @_locked
+    def load(self):
+        """从文件加载已有统计（包括其他进程记录的数据）"""
+        self._set_combos(read_section(self.path, "combos"))
+
+    def _set_combos(self, combos: dict):
+        # 兼容旧版本文件中缺少的字段
+        for record in combos.values():
+            for field, value in _empty_record().items():
+                record.setdefault(field, value)
+        self.combos = combos
+
+    def _add(self, template: str, event: str, **delta):
+        """累加一个组合的统计增量并合并写入文件，同时刷新内存中的统计"""
+        key = self.key(template, event)
+        add_counts(self.combos.setdefault(key, _empty_record()), delta)
+        self._set_combos(merge_counts(self.path, "combos", {key: delta}))
+
+    @staticmethod
+    def _tag_counts(tags: list) -> dict:
+        return {f"{tag['label']}-{tag['name']}": 1 for tag in tags}
+
+    @_locked
+    def record_job(self, template: str, event: str):
+        """记录一个新任务选中了该组合"""
+        self._add(template, event, jobs=1)
+
+    @_locked
+    def record_attempt(self, template: str, event: str, tokens: int = 0, seconds: float = 0.0, count: int = 1):
+        """记录生成调用（推测式生成时 count 为已完成的候选数）"""
+        self._add(template, event, attempts=count, tokens=tokens, generation_seconds=seconds)
+
+    @_locked
+    def record_parse_failure(self, template: str, event: str):
+        """记录一次解析失败"""
+        self._add(template, event, parse_failures=1)
+
+    @_locked
+    def record_tags(self, template: str, event: str, tags: list):
+        """记录一次解析成功的生成所选择的标签（无论之后是否通过验证）"""
+        self._add(template, event, generated_tags=self._tag_counts(tags))
+
+    @_locked
+    def record_validation_failure(self, template: str, event: str, errors: list):
+        """记录一次验证失败，按错误类别计数"""
+        failures = {}
+        for error in errors:
+            kind = classify_validation_error(error)
+            failures[kind] = failures.get(kind, 0) + 1
+        self._add(template, event, validation_failures=failures)
+
+    @_locked
+    def record_accept(self, template: str, event: str, tags: list, seconds: float, attempts: int):
+        """
+        记录一本通过验证的小说
+
+        Args:
+            template: 命令模板名称
+            event: 事件
+            tags: 小说选择的标签 [{"label": ..., "name": ...}]
+            seconds: 从任务开始到通过的耗时
+            attempts: 该任务经历的生成轮数（推测式生成的一轮包含多个候选）
+        """
+        self._add(template, event, accepted=1, accept_seconds=seconds,
+                  first_pass=1 if attempts <= 1 else 0, tags=self._tag_counts(tags))
+
+    @_locked
+    def failure_rate(self) -> float:
+        """所有组合的整体单次生成失败率（无数据时返回 0）"""
+        attempts = sum(r["attempts"] for r in self.combos.values())
+        accepted = sum(r["accepted"] for r in self.combos.values())
+        if attempts == 0:
+            return 0.0
+        return max(0.0, 1 - accepted / attempts)
+
+    @_locked
+    def summary(self) -> list[dict]:
+        """
+        汇总每个组合的产出指标，按每千 token 通过数降序排列
+
+        Returns:
+            [{"template", "event", "attempts", "accepted", "accept_rate",
+              "accepted_per_1k_tokens", "avg_seconds_to_accept", ...}, ...]
+        """
+        rows = []
+        for key, record in self.combos.items():
+            template, _, event = key.partition("|")
+            attempts = record["attempts"]
+            accepted = record["accepted"]
+            tokens = record["tokens"]
+            rows.append({
+                "template": template,
+                "event": event,
+                "attempts": attempts,
+                "accepted": accepted,
+                "accept_rate": accepted / attempts if attempts else 0.0,
+                "first_pass_rate": record["first_pass"] / accepted if accepted else 0.0,
+                "parse_failures": record["parse_failures"],
+                "validation_failures": dict(record["validation_failures"]),
+                "tokens_per_accepted": tokens / accepted if accepted else None,
+                "accepted_per_1k_tokens": accepted * 1000 / tokens if tokens else 0.0,
+                "avg_seconds_to_accept": record["accept_seconds"] / accepted if accepted else None,
+            })
+        rows.sort(key=lambda r: (r["accepted_per_1k_tokens"], r["accept_rate"]), reverse=True)
+        return rows
+
+    @_locked
+    def combo_weights(self, templates: list, events: list, prior_strength: float = 2.0,
+                      min_weight: float = 0.05) -> list[tuple[int, str, float]]:
+        """
+        计算每个 (模板, 事件) 组合的采样权重
+
+        权重为平滑后的单次生成通过率：以整体通过率为先验，数据少的组合接近整体水平，
+        并保留最小权重以便继续探索
+
+        Args:
+            templates: 模板名称列表（与 config["commands"] 顺序一致）
+            events: 事件列表
+            prior_strength: 先验的等效样本数
+            min_weight: 最小权重
+
+        Returns:
+            [(模板下标, 事件, 权重), ...]
+        """
+        prior = 1 - self.failure_rate() if self.combos else 1.0
+        weights = []
+        for index, template in enumerate(templates):
+            for event in events:
+                record = self.combos.get(self.key(template, event))
+                attempts = record["attempts"] if record else 0
+                accepted = record["accepted"] if record else 0
+                rate = (accepted + prior * prior_strength) / (attempts + prior_strength)
+                weights.append((index, event, max(rate, min_weight)))
+        return weights
+
+    @_locked
+    def tag_summary(self) -> list[dict]:
+        """
+        每个标签的生成次数、通过数和通过率（所有组合合计），按通过率降序排列
+
+        Returns:
+            [{"tag", "generated", "accepted", "accept_rate"}, ...]
+        """
+        generated, accepted = {}, {}
+        for record in self.combos.values():
+            add_counts(generated, record["generated_tags"])
+            add_counts(accepted, record["tags"])
+        rows = [
+            {
+                "tag": tag,
+                "generated": count,
+                "accepted": accepted.get(tag, 0),
+                "accept_rate": accepted.get(tag, 0) / count,
+            }
+            for tag, count in generated.items()
+        ]
+        rows.sort(key=lambda r: r["accept_rate"], reverse=True)
+        return rows
+
+    def sample_combination(self, templates: list, events: list) -> tuple[int, str]:
+        """
+        按自适应权重抽取一个 (模板下标, 事件) 组合
+
+        Returns:
+            (模板下标, 事件)
+        """
+        weights = self.combo_weights(templates, events)
+        index, event, _ = random.choices(weights, weights=[w for _, _, w in weights])[0]
+        return index, event
+
+
+if __name__ == "__main__":
+    # 测试代码
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stats = YieldStats(Path(tmp_dir) / "stats.json")
+
+        stats.record_job("template1_v2.txt", "末日求生")
+        stats.record_attempt("template1_v2.txt", "末日求生", tokens=30000, seconds=120)
+        stats.record_tags("template1_v2.txt", "末日求生", [{"label": "主题", "name": "现代言情"}])
+        stats.record_validation_failure("template1_v2.txt", "末日求生", ["小说内容少于8000字，当前字数: 5000"])
+        stats.record_attempt("template1_v2.txt", "末日求生", tokens=32000, seconds=130)
+        stats.record_tags("template1_v2.txt", "末日求生", [{"label": "主题", "name": "科幻末世"}])
+        stats.record_accept("template1_v2.txt", "末日求生",
+                            [{"label": "主题", "name": "科幻末世"}], seconds=250, attempts=2)
+
+        stats.record_job("template1_upgraded.txt", "时空穿越")
+        stats.record_attempt("template1_upgraded.txt", "时空穿越", tokens=28000, seconds=110)
+        stats.record_tags("template1_upgraded.txt", "时空穿越", [{"label": "情节", "name": "穿越"}])
+        stats.record_accept("template1_upgraded.txt", "时空穿越",
+                            [{"label": "情节", "name": "穿越"}], seconds=110, attempts=1)
+
+        # 另一个进程（实例）同时记录：合并写入，不覆盖前面的计数
+        other = YieldStats(stats.path)
+        stats.record_job("template1_v2.txt", "末日求生")
+        other.record_job("template1_v2.txt", "末日求生")
+        stats.record_job("template1_v2.txt", "末日求生")
+
+        reloaded = YieldStats(stats.path)
+        assert reloaded.combos[YieldStats.key("template1_v2.txt", "末日求生")]["jobs"] == 4
+        for row in reloaded.summary():
+            print(row)
+        for row in reloaded.tag_summary():
+            print(row)
+
+        templates = ["template1_v2.txt", "template1_upgraded.txt"]
+        events = ["末日求生", "时空穿越"]
+        for index, event, weight in reloaded.combo_weights(templates, events):
+            print(f"  {templates[index]} + {event}: {weight:.3f}")
+        print("抽样结果:", reloaded.sample_combination(templates, events))
@@ -0,0 +1,369 @@
+"""
+多机队列工作进程
+从共享的 SQLite 任务队列（utils/work_queue.py）领取规划好的 (模板, 事件) 任务并生成小说：
+
+    python worker.py plan --count 100          # 按模板和事件组合规划任务
+    python worker.py run --worker-id host-a    # 领取并执行任务，队列为空时退出
+    python worker.py status                    # 查看队列状态
+    python worker.py self-test                 # 离线测试续约、检查点恢复和租约丢失
+
+队列默认使用 WAL 模式，只适用于同一台机器上的多个工作进程；多台机器通过网络目录共享队列时，
+所有命令都要加 --journal-mode delete（网络文件系统必须正确支持文件锁，见 utils/work_queue.py），
+近重复索引（--dedup-path）使用同样的日志模式
+
+每个工作进程的输出写入 output/workers/<worker_id>/，多台机器不会互相覆盖；产出统计和模型统计
+由所有工作进程共用（--stats-dir，默认 output/stats，记录时在文件锁内合并），plan 在开启自适应采样时
+（NOVEL_ADAPTIVE_SAMPLING=1）按合并后的产出统计为组合加权；
+GenerateNovelNode 生成完成后立即保存检查点，进程崩溃后接手的进程直接从解析步骤继续，不必重新生成；
+租约丢失后在下一次生成或保存之前中止任务，不会与接手的进程重复保存
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from flow import create_novel_flow
+from main import load_config, create_services, create_shared
+from utils.dedup_index import chapter_text, DEFAULT_INDEX_FILE
+from utils.novel_parser import parse_novel
+from utils.work_queue import WorkQueue, LeaseLost, DEFAULT_QUEUE_FILE
+from utils.profiling import profile_job
+from utils.yield_stats import YieldStats
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    任务执行期间定期续约（包括同一批次中尚未开始的任务）
+
+    流程节点通过 shared["lease"] 使用：生成前和保存前调用 ensure() 确认租约仍然有效，
+    生成完成后调用 checkpoint() 立即保存检查点
+    """
+
+    def __init__(self, queue, job_id, worker_id, held_ids=()):
+        super().__init__(daemon=True)
+        # queue 供流程线程保存检查点；SQLite 连接不能跨线程使用，续约线程另开连接
+        self.queue = queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = queue.lease_seconds / 3
+        self.held_ids = list(held_ids)
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+
+    def run(self):
+        queue = WorkQueue(self.queue.path, lease_seconds=self.queue.lease_seconds,
+                          journal_mode=self.queue.journal_mode)
+        try:
+            while not self.stopped.wait(self.interval):
+                ok = queue.heartbeat(self.job_id, self.worker_id)
+                for held_id in self.held_ids:
+                    queue.heartbeat(held_id, self.worker_id)
+                if not ok:
+                    self._mark_lost()
+                    return
+        finally:
+            queue.close()
+
+    def _mark_lost(self):
+        if not self.lost.is_set():
+            print(f"⚠️  任务 {self.job_id} 的租约已丢失")
+        self.lost.set()
+
+    def ensure(self):
+        """租约已丢失时抛出 LeaseLost，中止流程"""
+        if self.lost.is_set():
+            raise LeaseLost(f"任务 {self.job_id} 的租约已丢失")
+
+    def checkpoint(self, shared):
+        """保存生成结果作为检查点（同时续约），租约已丢失时抛出 LeaseLost"""
+        self.ensure()
+        ok = self.queue.checkpoint(self.job_id, self.worker_id, {
+            "prompt": shared["prompt"],
+            "raw_response": shared["raw_response"],
+            "job": shared.get("job"),
+            # 恢复后的结果计入生成时使用的模型；验证失败重新生成时沿用原来的输出上限和分段方式
+            "generation_plan": shared.get("generation_plan"),
+            "generation_models": shared.get("generation_models"),
+        })
+        if not ok:
+            self._mark_lost()
+            self.ensure()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(queue, job, worker_id, config, services, output_dir, held_ids=()):
+    """执行一个队列任务并报告结果"""
+    shared = create_shared(config, services, {"template": job["template"], "event": job["event"]})
+    shared["output_dir"] = output_dir
+
+    checkpoint = job["checkpoint"]
+    if checkpoint and checkpoint.get("raw_response"):
+        # 从检查点恢复：跳过提示词构建和生成，直接解析已生成的响应
+        print(f"任务 {job['id']}: 从检查点恢复")
+        shared["prompt"] = checkpoint["prompt"]
+        shared["raw_response"] = checkpoint["raw_response"]
+        for key in ("job", "generation_plan", "generation_models"):
+            if checkpoint.get(key):
+                shared[key] = checkpoint[key]
+        flow = create_novel_flow(resume=True)
+    else:
+        flow = create_novel_flow()
+
+    keeper = LeaseKeeper(queue, job["id"], worker_id, held_ids)
+    shared["lease"] = keeper
+    keeper.start()
+    try:
+        with profile_job(shared, name=f"job-{job['id']}-{job['attempts']}"):
+            flow.run(shared)
+        if not shared.get("output_files"):
+            raise RuntimeError("流程结束但没有保存小说")
+    except LeaseLost as e:
+        # 任务已被其他进程领取，不再上报结果
+        keeper.stop()
+        print(f"⚠️  {e}，中止任务")
+        return False
+    except Exception as e:
+        keeper.stop()
+        traceback.print_exc()
+        queue.fail(job["id"], worker_id, f"{type(e).__name__}: {e}")
+        return False
+    keeper.stop()
+
+    result = {
+        "worker": worker_id,
+        "title": shared["novel"]["title"],
+        "output_files": shared["output_files"],
+        "tokens": shared.get("job", {}).get("tokens", 0),
+    }
+    if not queue.complete(job["id"], worker_id, result):
+        # 保存之后租约才过期，任务已被其他进程领取，本次结果仍保留在本地输出目录中
+        print(f"⚠️  任务 {job['id']} 的租约已丢失，结果未上报")
+        return False
+    return True
+
+
+def plan(queue, count, max_attempts, stats_dir):
+    """规划任务；开启自适应采样时按所有工作进程合并的产出统计为 (模板, 事件) 组合加权"""
+    config = load_config()
+    templates, events = config["command_names"], config["events"]
+    weights = None
+    if config["adaptive_sampling"]:
+        stats = YieldStats(f"{stats_dir}/yield_stats.json")
+        weights = [weight for _, _, weight in stats.combo_weights(templates, events)]
+    return queue.plan_jobs(templates, events, count, max_attempts, weights=weights)
+
+
+def run_worker(queue_path, worker_id, batch, lease_seconds, wait, journal_mode="WAL", stats_dir="output/stats",
+               dedup_path=DEFAULT_INDEX_FILE):
+    queue = WorkQueue(queue_path, lease_seconds=lease_seconds, journal_mode=journal_mode)
+    output_dir = f"output/workers/{worker_id}"
+
+    config = load_config()
+    config["echo_stream"] = False
+    # 统计文件和近重复索引由所有工作进程共用，自适应采样、模型选择和重复检测基于全部进程的数据
+    services = create_services(stats_dir=stats_dir, dedup_path=dedup_path, journal_mode=journal_mode)
+
+    done = failed = 0
+    while True:
+        jobs = queue.claim(worker_id, batch=batch)
+        if not jobs:
+            # 其他进程持有的任务可能因崩溃而租约过期，在它们结束前继续等待
+            counts = queue.counts()
+            if not wait and not counts.get("leased") and not counts.get("expired"):
+                break
+            time.sleep(min(10, lease_seconds / 3))
+            continue
+
+        for index, job in enumerate(jobs):
+            # 同一批次中排在后面的任务可能已在等待期间丢失租约
+            if not queue.heartbeat(job["id"], worker_id):
+                print(f"⚠️  任务 {job['id']} 的租约已丢失，跳过")
+                continue
+            print(f"\n[{worker_id}] 任务 {job['id']} (第 {job['attempts']} 次领取): "
+                  f"{job['template']} + {job['event']}")
+            held_ids = [held["id"] for held in jobs[index + 1:]]
+            if run_job(queue, job, worker_id, config, services, output_dir, held_ids):
+                done += 1
+            else:
+                failed += 1
+
+    print(f"\n[{worker_id}] 队列已空：完成 {done}，失败 {failed}，队列状态: {queue.counts()}")
+    queue.close()
+
+
+def _self_test_response(seed, chapters=11):
+    """测试用的模型响应：11 章时能通过解析和验证，不同 seed 的正文互不相似"""
+    rng = random.Random(seed)
+    chars = "天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏闰余成岁律吕调阳云腾致雨露结为霜"
+    body = "\n".join(
+        f"## 第{i}章 标题{i}\n\n" + "\n".join("".join(rng.choice(chars) for _ in range(150)) + "。"
+                                             for _ in range(6))
+        for i in range(1, chapters + 1)
+    )
+    return (f"TITLE{{测试小说{seed}}}TITLE\nTAG{{主题-科幻末世,情节-穿越}}TAG\nINTRO{{简介}}INTRO\n"
+            f"CONTENT{{\n{body}\n--END--\n}}CONTENT")
+
+
+def self_test():
+    """离线测试续约、检查点恢复和租约丢失后中止（模拟模型调用，不调用 Gemini API）"""
+    from utils.model_policy import ModelPolicy
+    from utils.token_budget import TokenBudget, estimate_tokens
+
+    class FakePolicy(ModelPolicy):
+        """按顺序返回预设响应的模型策略，记录每次调用的参数，生成时可执行 on_generate"""
+
+        def __init__(self, responses=(), on_generate=None):
+            super().__init__(path=None, explore_rate=0.0)
+            self.responses = list(responses)
+            self.on_generate = on_generate
+            self.calls = []
+
+        def call(self, task, call_fn, **kwargs):
+            def fake_call(model, temperature, **call_kwargs):
+                self.calls.append(call_kwargs)
+                if self.on_generate is not None:
+                    self.on_generate()
+                return self.responses.pop(0)
+            return super().call(task, fake_call, **kwargs)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        config = load_config()
+        config["echo_stream"] = False
+        services = create_services(stats_dir=str(tmp_dir / "stats"), dedup_path=str(tmp_dir / "index.db"))
+        services["token_budget"] = TokenBudget(count_fn=lambda text, model: estimate_tokens(text))
+        index = services["dedup_index"]
+        output_dir = str(tmp_dir / "output")
+        # 租约足够长，测试期间续约线程不会续约；需要时直接让租约过期
+        queue = WorkQueue(tmp_dir / "jobs.db", lease_seconds=60)
+        queue.plan_jobs(config["command_names"], config["events"], 4)
+
+        def take_over(job_id, worker_id):
+            """让任务的租约过期并由 worker_id 重新领取"""
+            queue.conn.execute("UPDATE jobs SET lease_expires = 0 WHERE id = ?", (job_id,))
+            job = queue.claim(worker_id)[0]
+            assert job["id"] == job_id
+            return job
+
+        def job_row(job_id):
+            return queue.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        # 1. 续约线程在租约到期前续约；检查点包含生成计划和模型；租约被抢走后 checkpoint 抛出 LeaseLost
+        short_queue = WorkQueue(tmp_dir / "jobs.db", lease_seconds=0.3)
+        job = short_queue.claim("keeper")[0]
+        keeper = LeaseKeeper(short_queue, job["id"], "keeper")
+        keeper.start()
+        time.sleep(1.0)
+        row = job_row(job["id"])
+        assert row["lease_owner"] == "keeper" and row["lease_expires"] > time.time(), "续约线程未能续约"
+        plan = {"mode": "single", "max_output_tokens": 12345, "thinking_budget": 678, "parts": []}
+        shared = {"prompt": "提示词", "raw_response": "响应", "job": None,
+                  "generation_plan": plan, "generation_models": {"novel_body": "gemini-2.5-pro"}}
+        keeper.checkpoint(shared)
+        keeper.stop()
+        saved = json.loads(job_row(job["id"])["checkpoint"])
+        assert saved["generation_plan"] == plan and saved["generation_models"] == shared["generation_models"]
+        take_over(job["id"], "thief")
+        try:
+            keeper.checkpoint(shared)
+            raise AssertionError("租约丢失后 checkpoint 应抛出 LeaseLost")
+        except LeaseLost:
+            pass
+        assert keeper.lost.is_set()
+        short_queue.close()
+        print("[OK] 续约和检查点正常")
+
+        # 2. 第一个进程生成并保存后、上报完成前崩溃：检查点中有响应，小说也已加入近重复索引
+        #    接手的进程从检查点恢复：索引中的同一本小说不算重复，结果计入检查点中的模型
+        policy = services["model_policy"] = FakePolicy()
+        job = queue.claim("crashed")[0]
+        response = _self_test_response(1)
+        novel = parse_novel(response)
+        queue.checkpoint(job["id"], "crashed", {"prompt": "提示词", "raw_response": response, "job": None,
+                                                "generation_plan": None,
+                                                "generation_models": {"novel_body": "gemini-2.5-pro"}})
+        index.add(novel["title"], index.signature(chapter_text(novel)),
+                  ref=str(Path(output_dir) / "novel" / f"{novel['title']}.json"))
+        job = take_over(job["id"], "resumed")
+        assert job["checkpoint"]["raw_response"] == response
+        assert run_job(queue, job, "resumed", config, services, output_dir)
+        assert job_row(job["id"])["status"] == "done"
+        assert index.count() == 1 and not policy.calls
+        assert policy.stats["novel_body"]["gemini-2.5-pro"]["accepted"] == 1
+
+        # 3. 恢复的响应未通过验证：按检查点中的生成计划重新生成
+        policy = services["model_policy"] = FakePolicy([_self_test_response(2)])
+        job = queue.claim("crashed")[0]
+        queue.checkpoint(job["id"], "crashed", {"prompt": "提示词", "raw_response": _self_test_response(3, chapters=2),
+                                                "job": None, "generation_plan": plan,
+                                                "generation_models": {"novel_body": "gemini-2.5-flash"}})
+        job = take_over(job["id"], "resumed")
+        assert run_job(queue, job, "resumed", config, services, output_dir)
+        assert job_row(job["id"])["status"] == "done"
+        assert policy.calls[0]["max_output_tokens"] == 12345 and policy.calls[0]["thinking_budget"] == 678
+        assert policy.stats["novel_body"]["gemini-2.5-flash"]["rejected"] == 1
+        print("[OK] 检查点恢复正常")
+
+        # 4. 生成期间租约被其他进程抢走：保存检查点时中止，不上报失败，也不保存小说
+        job = queue.claim("slow")[0]
+        services["model_policy"] = FakePolicy([_self_test_response(4)],
+                                              on_generate=lambda: take_over(job["id"], "thief"))
+        assert not run_job(queue, job, "slow", config, services, output_dir)
+        row = job_row(job["id"])
+        assert row["status"] == "leased" and row["lease_owner"] == "thief" and row["error"] is None
+        assert row["checkpoint"] is None
+        assert not (Path(output_dir) / "novel" / "测试小说4.json").exists()
+        print("[OK] 租约丢失后中止任务")
+        queue.close()
+        index.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多机队列工作进程")
+    parser.add_argument("--queue", default=DEFAULT_QUEUE_FILE, help="任务队列数据库文件")
+    parser.add_argument("--journal-mode", choices=["wal", "delete"], default="wal",
+                        help="队列和近重复索引的 SQLite 日志模式：wal 只用于单机，多台机器共享网络目录时使用 delete")
+    parser.add_argument("--stats-dir", default="output/stats", help="所有工作进程共用的统计目录")
+    parser.add_argument("--dedup-path", default=DEFAULT_INDEX_FILE,
+                        help="所有工作进程共用的近重复索引文件（与队列使用相同的日志模式）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = subparsers.add_parser("plan", help="规划 (模板, 事件) 任务")
+    plan_parser.add_argument("--count", type=int, required=True, help="任务数")
+    plan_parser.add_argument("--max-attempts", type=int, default=3, help="每个任务最多被领取的次数")
+
+    run_parser = subparsers.add_parser("run", help="领取并执行任务")
+    run_parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    run_parser.add_argument("--batch", type=int, default=1, help="每次领取的任务数")
+    run_parser.add_argument("--lease", type=float, default=900, help="租约时长（秒）")
+    run_parser.add_argument("--wait", action="store_true", help="队列为空时继续等待新任务")
+
+    subparsers.add_parser("status", help="查看队列状态")
+    subparsers.add_parser("self-test", help="离线测试续约、检查点恢复和租约丢失")
+
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        queue = WorkQueue(args.queue, journal_mode=args.journal_mode)
+        count = plan(queue, args.count, args.max_attempts, args.stats_dir)
+        print(f"已规划 {count} 个任务，队列状态: {queue.counts()}")
+    elif args.command == "run":
+        run_worker(args.queue, args.worker_id, args.batch, args.lease, args.wait, args.journal_mode,
+                   args.stats_dir, args.dedup_path)
+    elif args.command == "status":
+        print(WorkQueue(args.queue, journal_mode=args.journal_mode).counts())
+    elif args.command == "self-test":
+        self_test()
+
+
+if __name__ == "__main__":
+    main()